@@ -1,45 +1,342 @@
 import google.generativeai as genai
+import asyncio
 import os
 import json
+import logging
+import orjson
+import re
+import string
+import textwrap
+import numpy as np
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from types import MappingProxyType
 from typing import Dict, List, Any
 from datetime import datetime
 
+from gemini_models import UNSUPPORTED_MODEL_PREFIXES
+
+logger = logging.getLogger(__name__)
+
+# Patterns for the plain-text fallback parser in _extract_advice_from_text
+_SUMMARY_RE = re.compile(r'^(.+?)(?:\n\n|\n[A-Z]|$)', re.MULTILINE | re.DOTALL)
+_REC_RE = re.compile(r'(?:^|\n)(?:\d+\.|\*|\-)\s*(.+?)(?:\n|$)', re.MULTILINE)
+
+# Advice responses are a single JSON object well under 1K tokens; capping the
+# output length bounds generation time and JSON mode removes markdown fences
+_GEN_CFG = genai.GenerationConfig(
+    max_output_tokens=2048,
+    temperature=0.3,
+    response_mime_type='application/json',
+)
+
+# Category advice is a short list of recommendations
+_CATEGORY_GEN_CFG = genai.GenerationConfig(
+    max_output_tokens=256,
+    temperature=0.3,
+    response_mime_type='application/json',
+)
+
+# Budget status indexed by how many of the 80% / 100% thresholds were passed
+_BUDGET_STATUS = ('good', 'warning', 'over')
+
+def _dumps(obj: Any) -> str:
+    """Serialize a prompt payload block as compact JSON"""
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+# Instructions and output schema for the advice prompt. They never change
+# between requests, so they are bound to the model as its system instruction
+# and the user turn holds only the user's data. The instruction is still sent
+# and billed with every request.
+_STATIC_SYSTEM_PROMPT = """You are a personal finance advisor AI. Analyze the financial data you are given for the stated analysis period and provide personalized, actionable advice.
+
+Please provide:
+1. A brief summary of their financial situation over the analysis period, highlighting trends and patterns
+2. Specific areas of concern (budget overruns, increasing spending trends, high spending categories)
+3. 3-5 actionable recommendations to improve their finances based on the analysis period
+4. Positive reinforcement for good financial habits or improvements you notice
+5. A confidence score (0-100) for your advice based on the data quality
+
+When analyzing trends:
+- Identify categories with increasing spending that may need attention
+- Note categories with decreasing spending as positive changes
+- Compare current month spending to the average over the analysis period
+- Consider seasonal patterns if visible
+
+Format your response as JSON with the following structure:
+{
+    "summary": "Brief summary of financial situation over the analysis period, including trends",
+    "concerns": ["List of specific concerns based on trends and current spending"],
+    "recommendations": [
+        {
+            "title": "Recommendation title",
+            "description": "Detailed description based on the analysis period",
+            "priority": "high/medium/low",
+            "potential_savings": "Estimated savings amount"
+        }
+    ],
+    "positive_feedback": ["List of positive observations from the analysis period"],
+    "confidence_score": 85,
+    "next_steps": ["Immediate action items based on trends"]
+}
+
+Keep advice practical, encouraging, and specific. Focus on actionable steps based on the spending patterns over the analysis period rather than generic advice.
+"""
+
+# Per-request data section of the advice prompt, filled in by _create_advice_prompt
+_PROMPT_TEMPLATE = string.Template(textwrap.dedent("""\
+    ANALYSIS PERIOD: Last ${period_months} months
+
+    CURRENT MONTH SPENDING:
+    ${current_spending_json}
+
+    MONTHLY SPENDING BREAKDOWN (Last ${period_months} Months):
+    ${monthly_spending_json}
+
+    SPENDING TRENDS BY CATEGORY:
+    ${category_trends_json}
+
+    BUDGET STATUS (category:spent/limit):
+    ${budget_status}
+
+    NEXT MONTH PREDICTIONS:
+    ${predictions_json}
+
+    SPENDING SUMMARY:
+    - Current Month Total: ₹${total_current}
+    - ${period_months}-Month Total: ₹${total_period}
+    - Average Monthly Spending: ₹${average_monthly}
+    - Predicted Next Month: ₹${total_predicted}
+    """))
+
+# The backend always requests a 3-month analysis, so that period is rendered once
+_PROMPT_TEMPLATE_3MO = string.Template(_PROMPT_TEMPLATE.safe_substitute(period_months=3))
+
+# Read-only defaults for advice fields missing from a model response
+_FIELD_DEFAULTS = MappingProxyType({
+    'summary': 'Unable to analyze financial data at this time.',
+    'concerns': ['Unable to identify specific concerns'],
+    'recommendations': [{
+        'title': 'Review your spending',
+        'description': 'Take time to review your recent transactions and identify areas for improvement.',
+        'priority': 'medium',
+        'potential_savings': 'Variable'
+    }],
+    'positive_feedback': ['You are actively tracking your finances, which is a great start!'],
+    'confidence_score': 50,
+    'next_steps': ['Continue monitoring your spending patterns']
+})
+
+# Generic advice returned when Gemini is unavailable; callers get a shallow copy
+_FALLBACK_ADVICE = MappingProxyType({
+    'summary': 'Your financial data has been analyzed. Here are some general recommendations to help improve your financial health.',
+    'concerns': ['Unable to analyze specific concerns at this time'],
+    'recommendations': [
+        {
+            'title': 'Track Your Expenses',
+            'description': 'Continue recording all your transactions to get better insights into your spending patterns.',
+            'priority': 'high',
+            'potential_savings': 'Helps identify saving opportunities'
+        },
+        {
+            'title': 'Review Your Budget',
+            'description': 'Regularly check your budget against actual spending to ensure you stay on track.',
+            'priority': 'high',
+            'potential_savings': 'Prevents overspending'
+        },
+        {
+            'title': 'Set Financial Goals',
+            'description': 'Define clear financial objectives to stay motivated and focused.',
+            'priority': 'medium',
+            'potential_savings': 'Long-term financial improvement'
+        }
+    ],
+    'positive_feedback': ['You are actively managing your finances by using this platform.'],
+    'confidence_score': 40,
+    'next_steps': ['Continue using the platform regularly for better insights.']
+})
+
 class AdviceService:
+    # Fixed attribute set; no per-instance __dict__
+    __slots__ = ('api_key', 'hedge', '_models', '_executor', '_model_names')
+
     def __init__(self):
         self.api_key = os.getenv("GEMINI_API_KEY")
         if not self.api_key:
             raise ValueError("GEMINI_API_KEY environment variable is required")
         
-        genai.configure(api_key=self.api_key)
-        self.model_names = self._detect_text_models()
-        if not self.model_names:
-            self.model_names = [
-                "gemini-1.5-flash",
-                "gemini-1.0-pro",
-                "gemini-pro",
-            ]
-        print(f"[Advice] Model candidates: {self.model_names}")
+        self._models = {}
+        self._model_names = None
+        # Hedged requests race the first two candidate models; off by default
+        # because every hedged call spends API quota on both of them
+        self.hedge = os.getenv("ADVICE_HEDGE_REQUESTS", "false").lower() == "true"
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="advice-hedge") if self.hedge else None
 
-    def _detect_text_models(self):
+    async def warmup(self):
+        """Send a 1-token request through the preferred model to open the async API channel"""
         try:
-            models = genai.list_models()
-            names = []
-            for m in models:
-                name = getattr(m, 'name', '') or ''
-                if name.startswith('models/'):
-                    name = name.split('models/')[-1]
-                methods = set(getattr(m, 'supported_generation_methods', []) or [])
-                if 'generateContent' in methods:
-                    # Prefer non-vision text models first
-                    names.append(name)
-            names.sort(key=lambda n: (
-                0 if '1.5' in n and 'flash' in n else 1,
-                0 if 'pro' in n else 1,
-                n
-            ))
-            return names
+            names = await self.resolve_model_names()
+            model = self._get_model(names[0])
+            await model.generate_content_async("ping", generation_config={'max_output_tokens': 1})
+        except Exception as e:
+            logger.warning("Warmup request failed: %s", e)
+
+    @property
+    def model_names(self) -> List[str]:
+        """Candidate model names, discovered on first use rather than at construction"""
+        names = self._model_names
+        if names is None:
+            names = self._detect_text_models(self.api_key)
+            if names:
+                logger.info("Model candidates: %s", names)
+                self._model_names = names
+            else:
+                # Discovery failed: use the defaults for now but do not keep
+                # them, so a transient list_models() error is retried
+                names = [
+                    "gemini-1.5-flash",
+                    "gemini-1.5-flash-latest",
+                    "gemini-1.5-pro",
+                ]
+        return names
+
+    async def resolve_model_names(self) -> List[str]:
+        """model_names for async callers; discovery is a blocking HTTP call, so it runs on a thread"""
+        if self._model_names is not None:
+            return self._model_names
+        return await asyncio.to_thread(lambda: self.model_names)
+
+    @staticmethod
+    def _detect_text_models(api_key: str):
+        try:
+            return list(AdviceService._list_text_models(api_key))
         except Exception:
             return []
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _list_text_models(api_key: str):
+        # Cached per API key so list_models() runs once per process; failures
+        # raise and are therefore never cached.
+        models = genai.list_models()
+        names = []
+        for m in models:
+            name = getattr(m, 'name', '') or ''
+            if name.startswith('models/'):
+                name = name.split('models/')[-1]
+            methods = set(getattr(m, 'supported_generation_methods', []) or [])
+            if 'generateContent' in methods and not name.startswith(UNSUPPORTED_MODEL_PREFIXES):
+                # Prefer non-vision text models first
+                names.append(name)
+        names.sort(key=lambda n: (
+            0 if '1.5' in n and 'flash' in n else 1,
+            0 if 'pro' in n else 1,
+            n
+        ))
+        return tuple(names)
+
+    def _get_model(self, name: str, system_instruction: str = _STATIC_SYSTEM_PROMPT):
+        """Return a cached GenerativeModel for the given name and system instruction"""
+        key = (name, system_instruction)
+        model = self._models.get(key)
+        if model is None:
+            model = self._models[key] = genai.GenerativeModel(
+                name, system_instruction=system_instruction
+            )
+        return model
+    
+    def _split_candidates(self, model_names: List[str]):
+        """Candidate models as (hedged, sequential): the first two are raced when hedging is on"""
+        if self.hedge and len(model_names) > 1:
+            return model_names[:2], model_names[2:]
+        return [], model_names
+    
+    @staticmethod
+    def _usable(response) -> bool:
+        return bool(response and getattr(response, 'text', None))
+    
+    @staticmethod
+    def _require_response(response, last_err):
+        if response is None:
+            raise RuntimeError(str(last_err) if last_err else "Advice model generation failed")
+        return response
+    
+    def _generate(self, prompt: str, config=_GEN_CFG, system_instruction: str = _STATIC_SYSTEM_PROMPT):
+        """Run the prompt through the candidate models and return the first usable response"""
+        response = None
+        last_err = None
+        hedged, model_names = self._split_candidates(self.model_names)
+        if hedged:
+            response, last_err = self._generate_hedged(prompt, hedged, config, system_instruction)
+        for name in model_names if response is None else []:
+            try:
+                model = self._get_model(name, system_instruction)
+                response = model.generate_content(prompt, generation_config=config)
+                if self._usable(response):
+                    break
+            except Exception as e:
+                last_err = e
+        return self._require_response(response, last_err)
+    
+    async def _generate_async(self, prompt: str, config=_GEN_CFG, system_instruction: str = _STATIC_SYSTEM_PROMPT):
+        """Async variant of _generate"""
+        response = None
+        last_err = None
+        hedged, model_names = self._split_candidates(await self.resolve_model_names())
+        if hedged:
+            response, last_err = await self._generate_hedged_async(prompt, hedged, config, system_instruction)
+        for name in model_names if response is None else []:
+            try:
+                model = self._get_model(name, system_instruction)
+                response = await model.generate_content_async(prompt, generation_config=config)
+                if self._usable(response):
+                    break
+            except Exception as e:
+                last_err = e
+        return self._require_response(response, last_err)
+    
+    def _advice_prompt(self, current_spending: List[Dict], budgets: List[Dict],
+                       predictions: List[Dict], monthly_spending: Dict[str, Dict[str, float]],
+                       analysis_period_months: int):
+        """Build the advice prompt, or None when there is nothing to analyze (new user)"""
+        if not (current_spending or budgets or predictions or monthly_spending):
+            return None
+        analysis_data = self._prepare_analysis_data(
+            current_spending, budgets, predictions, 
+            monthly_spending, analysis_period_months
+        )
+        return self._create_advice_prompt(analysis_data)
+    
+    def _advice_result(self, response) -> Dict[str, Any]:
+        """Result for a completed generation; timestamped before parsing"""
+        generated_at = datetime.now().isoformat()
+        return {
+            "success": True,
+            "advice": self._parse_advice_response(response.text),
+            "raw_response": response.text,
+            "generated_at": generated_at
+        }
+    
+    def _no_data_result(self) -> Dict[str, Any]:
+        return {
+            "success": True,
+            "advice": self._get_fallback_advice(),
+            "generated_at": datetime.now().isoformat()
+        }
+    
+    def _error_result(self, error: Exception) -> Dict[str, Any]:
+        return {
+            "success": False,
+            "error": str(error),
+            "advice": self._get_fallback_advice()
+        }
+    
+    def _complete_event(self, parts: List[str]) -> Dict[str, Any]:
+        """Final stream event: the parsed advice, or the fallback if nothing was streamed"""
+        if parts:
+            return {'type': 'complete', 'advice': self._parse_advice_response("".join(parts)), 'success': True}
+        return {'type': 'complete', 'advice': self._get_fallback_advice(), 'success': False}
     
     def generate_advice(self, current_spending: List[Dict], budgets: List[Dict], 
                       predictions: List[Dict], user_id: int, 
@@ -47,46 +344,29 @@ class AdviceService:
                       analysis_period_months: int = 3) -> Dict[str, Any]:
         """Generate personalized financial advice using Gemini LLM"""
         try:
-            # Prepare data for analysis
-            analysis_data = self._prepare_analysis_data(
-                current_spending, budgets, predictions, 
-                monthly_spending, analysis_period_months
-            )
-            
-            # Create prompt for Gemini
-            prompt = self._create_advice_prompt(analysis_data)
-            
-            # Generate advice
-            response = None
-            last_err = None
-            for name in self.model_names:
-                try:
-                    model = genai.GenerativeModel(name)
-                    response = model.generate_content(prompt)
-                    if response and getattr(response, 'text', None):
-                        break
-                except Exception as e:
-                    last_err = e
-                    continue
-            if response is None:
-                raise RuntimeError(str(last_err) if last_err else "Advice model generation failed")
-            
-            # Parse response
-            advice_data = self._parse_advice_response(response.text)
-            
-            return {
-                "success": True,
-                "advice": advice_data,
-                "raw_response": response.text,
-                "generated_at": datetime.now().isoformat()
-            }
-            
+            prompt = self._advice_prompt(current_spending, budgets, predictions,
+                                         monthly_spending, analysis_period_months)
+            # Nothing to analyze: skip the model round-trip entirely
+            if prompt is None:
+                return self._no_data_result()
+            return self._advice_result(self._generate(prompt))
         except Exception as e:
-            return {
-                "success": False,
-                "error": str(e),
-                "advice": self._get_fallback_advice()
-            }
+            return self._error_result(e)
+    
+    async def generate_advice_async(self, current_spending: List[Dict], budgets: List[Dict], 
+                                    predictions: List[Dict], user_id: int, 
+                                    monthly_spending: Dict[str, Dict[str, float]] = None,
+                                    analysis_period_months: int = 3) -> Dict[str, Any]:
+        """Async variant of generate_advice that does not block the event loop"""
+        try:
+            prompt = self._advice_prompt(current_spending, budgets, predictions,
+                                         monthly_spending, analysis_period_months)
+            # Nothing to analyze: skip the model round-trip entirely
+            if prompt is None:
+                return self._no_data_result()
+            return self._advice_result(await self._generate_async(prompt))
+        except Exception as e:
+            return self._error_result(e)
     
     def generate_advice_stream(self, current_spending: List[Dict], budgets: List[Dict], 
                               predictions: List[Dict], user_id: int, 
@@ -94,98 +374,206 @@ class AdviceService:
                               analysis_period_months: int = 3):
         """Stream advice generation as it's being created"""
         try:
-            # Prepare data for analysis
-            analysis_data = self._prepare_analysis_data(
-                current_spending, budgets, predictions, 
-                monthly_spending, analysis_period_months
-            )
+            prompt = self._advice_prompt(current_spending, budgets, predictions,
+                                         monthly_spending, analysis_period_months)
+            # Nothing to analyze: skip the model round-trip entirely
+            if prompt is None:
+                yield {'type': 'complete', 'advice': self._get_fallback_advice(), 'success': True}
+                return
             
-            # Create prompt for Gemini
-            prompt = self._create_advice_prompt(analysis_data)
-            
-            # Stream response from Gemini
-            response_text = ""
+            # Stream response from Gemini. Fallback models are only tried
+            # until one of them produces its first chunk.
+            parts = []
+            stream = None
             for name in self.model_names:
                 try:
-                    model = genai.GenerativeModel(name)
-                    # Stream the response
-                    response = model.generate_content(prompt, stream=True)
-                    
-                    for chunk in response:
+                    model = self._get_model(name)
+                    candidate = iter(model.generate_content(prompt, stream=True, generation_config=_GEN_CFG))
+                    for chunk in candidate:
                         if hasattr(chunk, 'text') and chunk.text:
-                            response_text += chunk.text
-                            yield {'type': 'chunk', 'text': chunk.text, 'partial': True}
-                    
-                    if response_text:
-                        break
-                except Exception as e:
+                            # Emit the first chunk before any bookkeeping
+                            yield {'type': 'chunk', 'text': chunk.text, 'partial': True, 'ttft': True}
+                            parts.append(chunk.text)
+                            stream = candidate
+                            break
+                except Exception:
                     continue
+                if stream is not None:
+                    break
             
-            # Parse final response
-            if response_text:
-                advice_data = self._parse_advice_response(response_text)
-                yield {'type': 'complete', 'advice': advice_data, 'success': True}
-            else:
-                fallback = self._get_fallback_advice()
-                yield {'type': 'complete', 'advice': fallback, 'success': False}
+            # Stay on the model that started streaming; falling back mid-stream
+            # would send the client text from two different models
+            if stream is not None:
+                for chunk in stream:
+                    if hasattr(chunk, 'text') and chunk.text:
+                        parts.append(chunk.text)
+                        yield {'type': 'chunk', 'text': chunk.text, 'partial': True}
+            
+            yield self._complete_event(parts)
                 
         except Exception as e:
             yield {'type': 'error', 'error': str(e)}
     
+    async def generate_advice_stream_async(self, current_spending: List[Dict], budgets: List[Dict], 
+                                           predictions: List[Dict], user_id: int, 
+                                           monthly_spending: Dict[str, Dict[str, float]] = None,
+                                           analysis_period_months: int = 3):
+        """Async variant of generate_advice_stream that does not block the event loop"""
+        try:
+            prompt = self._advice_prompt(current_spending, budgets, predictions,
+                                         monthly_spending, analysis_period_months)
+            # Nothing to analyze: skip the model round-trip entirely
+            if prompt is None:
+                yield {'type': 'complete', 'advice': self._get_fallback_advice(), 'success': True}
+                return
+            
+            # Stream response from Gemini. Fallback models are only tried
+            # until one of them produces its first chunk.
+            parts = []
+            stream = None
+            for name in await self.resolve_model_names():
+                try:
+                    model = self._get_model(name)
+                    response = await model.generate_content_async(prompt, stream=True, generation_config=_GEN_CFG)
+                    candidate = response.__aiter__()
+                    async for chunk in candidate:
+                        if hasattr(chunk, 'text') and chunk.text:
+                            # Emit the first chunk before any bookkeeping
+                            yield {'type': 'chunk', 'text': chunk.text, 'partial': True, 'ttft': True}
+                            parts.append(chunk.text)
+                            stream = candidate
+                            break
+                except Exception:
+                    continue
+                if stream is not None:
+                    break
+            
+            # Stay on the model that started streaming; falling back mid-stream
+            # would send the client text from two different models
+            if stream is not None:
+                async for chunk in stream:
+                    if hasattr(chunk, 'text') and chunk.text:
+                        parts.append(chunk.text)
+                        yield {'type': 'chunk', 'text': chunk.text, 'partial': True}
+            
+            yield self._complete_event(parts)
+                
+        except Exception as e:
+            yield {'type': 'error', 'error': str(e)}
+    
+    def _generate_hedged(self, prompt: str, model_names: List[str], config=_GEN_CFG,
+                         system_instruction: str = _STATIC_SYSTEM_PROMPT, timeout: float = 30):
+        """Race several models on the same prompt and keep the first usable response"""
+        futures = [
+            self._executor.submit(self._get_model(name, system_instruction).generate_content,
+                                  prompt, generation_config=config)
+            for name in model_names
+        ]
+        last_err = None
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                try:
+                    response = future.result()
+                    if self._usable(response):
+                        return response, None
+                except Exception as e:
+                    last_err = e
+        except TimeoutError as e:
+            last_err = e
+        finally:
+            # Requests already in flight cannot be interrupted; this only
+            # drops the ones that have not started yet
+            for future in futures:
+                future.cancel()
+        return None, last_err
+    
+    async def _generate_hedged_async(self, prompt: str, model_names: List[str], config=_GEN_CFG,
+                                     system_instruction: str = _STATIC_SYSTEM_PROMPT, timeout: float = 30):
+        """Async variant of _generate_hedged; the losing request is cancelled"""
+        tasks = [
+            asyncio.ensure_future(self._get_model(name, system_instruction).generate_content_async(
+                prompt, generation_config=config))
+            for name in model_names
+        ]
+        last_err = None
+        try:
+            for next_done in asyncio.as_completed(tasks, timeout=timeout):
+                try:
+                    response = await next_done
+                    if self._usable(response):
+                        return response, None
+                except Exception as e:
+                    last_err = e
+        finally:
+            for task in tasks:
+                task.cancel()
+        return None, last_err
+    
     def _prepare_analysis_data(self, current_spending: List[Dict], 
                             budgets: List[Dict], predictions: List[Dict],
                             monthly_spending: Dict[str, Dict[str, float]] = None,
                             analysis_period_months: int = 3) -> Dict[str, Any]:
         """Prepare data for analysis"""
         # Calculate current month totals
-        current_totals = {}
+        current_totals = Counter()
         for spending in current_spending:
-            category = spending.get('category', 'other')
-            amount = abs(float(spending.get('total', 0)))
-            current_totals[category] = current_totals.get(category, 0) + amount
+            current_totals[spending.get('category', 'other')] += abs(float(spending.get('total', 0)))
         
-        # Process 3-month spending trends
-        monthly_trends = {}
-        category_trends = {}
-        if monthly_spending:
-            # Sort months chronologically
-            sorted_months = sorted(monthly_spending.keys())
-            for month in sorted_months:
-                monthly_trends[month] = monthly_spending[month]
-                # Track trends by category
-                for category, amount in monthly_spending[month].items():
-                    if category not in category_trends:
-                        category_trends[category] = []
-                    category_trends[category].append(amount)
+        # Process 3-month spending trends (months sorted chronologically)
+        monthly_trends = {month: monthly_spending[month] for month in sorted(monthly_spending)} if monthly_spending else {}
         
-        # Calculate trend indicators (increasing, decreasing, stable)
+        # Calculate trend indicators (increasing, decreasing, stable) on a
+        # (month x category) matrix with NaN where a category has no spending.
+        # Each category is compared over the months it appears in, and needs at
+        # least two of them, so first-time users skip this entirely.
         category_analysis = {}
-        for category, amounts in category_trends.items():
-            if len(amounts) >= 2:
-                recent_avg = sum(amounts[-2:]) / 2  # Last 2 months average
-                earlier_avg = sum(amounts[:-2]) / len(amounts[:-2]) if len(amounts) > 2 else amounts[0]
-                change_pct = ((recent_avg - earlier_avg) / earlier_avg * 100) if earlier_avg > 0 else 0
-                category_analysis[category] = {
-                    'trend': 'increasing' if change_pct > 10 else 'decreasing' if change_pct < -10 else 'stable',
-                    'change_percentage': round(change_pct, 1),
-                    'monthly_average': round(sum(amounts) / len(amounts), 2)
+        if len(monthly_trends) >= 2:
+            categories = list(dict.fromkeys(c for amounts in monthly_trends.values() for c in amounts))
+            arr = np.array(
+                [[amounts.get(c, np.nan) for c in categories] for amounts in monthly_trends.values()],
+                dtype=np.float64
+            )
+            present = ~np.isnan(arr)
+            counts = present.sum(axis=0)
+            # Move each column's values to the top, keeping their month order
+            packed = np.take_along_axis(arr, np.argsort(~present, axis=0, kind='stable'), axis=0)
+            last = packed[np.maximum(counts - 1, 0), np.arange(len(categories))]
+            previous = packed[np.maximum(counts - 2, 0), np.arange(len(categories))]
+            recent_avg = (last + previous) / 2  # Last 2 months average
+            earlier = np.arange(len(arr))[:, None] < counts - 2
+            earlier_avg = np.where(
+                counts > 2,
+                np.where(earlier, packed, 0.0).sum(axis=0) / np.maximum(counts - 2, 1),
+                packed[0]
+            )
+            with np.errstate(divide='ignore', invalid='ignore'):
+                change_pct = np.where(earlier_avg > 0, (recent_avg - earlier_avg) / earlier_avg * 100, 0.0)
+            monthly_avg = np.where(present, arr, 0.0).sum(axis=0) / np.maximum(counts, 1)
+            trends = np.where(change_pct > 10, 'increasing',
+                              np.where(change_pct < -10, 'decreasing', 'stable'))
+            for i in np.flatnonzero(counts >= 2):
+                category_analysis[categories[i]] = {
+                    'trend': str(trends[i]),
+                    'change_percentage': round(float(change_pct[i]), 1),
+                    'monthly_average': round(float(monthly_avg[i]), 2)
                 }
         
         # Calculate budget status
         budget_status = {}
+        spent_for = current_totals.get
         for budget in budgets:
             category = budget.get('category', 'other')
             limit = float(budget.get('limit_amount', 0))
-            spent = current_totals.get(category, 0)
-            remaining = limit - spent
+            spent = spent_for(category, 0)
             percentage = (spent / limit * 100) if limit > 0 else 0
             
             budget_status[category] = {
                 'limit': limit,
                 'spent': spent,
-                'remaining': remaining,
+                'remaining': limit - spent,
                 'percentage': percentage,
-                'status': 'over' if percentage > 100 else 'warning' if percentage > 80 else 'good'
+                # good / warning (>80%) / over (>100%)
+                'status': _BUDGET_STATUS[(percentage > 80) + (percentage > 100)]
             }
         
         # Prepare predictions summary
@@ -196,13 +584,12 @@ class AdviceService:
             predictions_summary[category] = amount
         
         # Calculate 3-month totals
-        three_month_total = 0
-        if monthly_spending:
-            for month_data in monthly_spending.values():
-                three_month_total += sum(month_data.values())
+        three_month_total = sum(
+            amount for month_data in monthly_spending.values() for amount in month_data.values()
+        ) if monthly_spending else 0
         
         return {
-            'current_spending': current_totals,
+            'current_spending': dict(current_totals),
             'monthly_spending': monthly_trends,
             'category_trends': category_analysis,
             'budget_status': budget_status,
@@ -215,82 +602,39 @@ class AdviceService:
         }
     
     def _create_advice_prompt(self, analysis_data: Dict[str, Any]) -> str:
-        """Create prompt for Gemini LLM"""
-        period_months = analysis_data.get('analysis_period_months', 3)
-        
-        prompt = f"""
-        You are a personal finance advisor AI. Analyze the following financial data from the last {period_months} months and provide personalized, actionable advice.
-
-        CURRENT MONTH SPENDING:
-        {json.dumps(analysis_data['current_spending'], indent=2)}
-
-        MONTHLY SPENDING BREAKDOWN (Last {period_months} Months):
-        {json.dumps(analysis_data.get('monthly_spending', {}), indent=2)}
-
-        SPENDING TRENDS BY CATEGORY:
-        {json.dumps(analysis_data.get('category_trends', {}), indent=2)}
+        """Create the per-request prompt for Gemini LLM.
 
-        BUDGET STATUS:
-        {json.dumps(analysis_data['budget_status'], indent=2)}
-
-        NEXT MONTH PREDICTIONS:
-        {json.dumps(analysis_data['predictions'], indent=2)}
-
-        SPENDING SUMMARY:
-        - Current Month Total: ₹{analysis_data['total_current_spending']:.2f}
-        - {period_months}-Month Total: ₹{analysis_data.get('total_three_month_spending', 0):.2f}
-        - Average Monthly Spending: ₹{analysis_data.get('average_monthly_spending', 0):.2f}
-        - Predicted Next Month: ₹{analysis_data['total_predicted_spending']:.2f}
-
-        Please provide:
-        1. A brief summary of their financial situation over the last {period_months} months, highlighting trends and patterns
-        2. Specific areas of concern (budget overruns, increasing spending trends, high spending categories)
-        3. 3-5 actionable recommendations to improve their finances based on the {period_months}-month analysis
-        4. Positive reinforcement for good financial habits or improvements you notice
-        5. A confidence score (0-100) for your advice based on the data quality
-
-        When analyzing trends:
-        - Identify categories with increasing spending that may need attention
-        - Note categories with decreasing spending as positive changes
-        - Compare current month spending to the {period_months}-month average
-        - Consider seasonal patterns if visible
-
-        Format your response as JSON with the following structure:
-        {{
-            "summary": "Brief summary of financial situation over the last {period_months} months, including trends",
-            "concerns": ["List of specific concerns based on trends and current spending"],
-            "recommendations": [
-                {{
-                    "title": "Recommendation title",
-                    "description": "Detailed description based on {period_months}-month analysis",
-                    "priority": "high/medium/low",
-                    "potential_savings": "Estimated savings amount"
-                }}
-            ],
-            "positive_feedback": ["List of positive observations from the {period_months}-month data"],
-            "confidence_score": 85,
-            "next_steps": ["Immediate action items based on trends"]
-        }}
-
-        Keep advice practical, encouraging, and specific. Focus on actionable steps based on the {period_months}-month spending patterns rather than generic advice.
+        Only the user's data goes here; the instructions and output schema
+        live in _STATIC_SYSTEM_PROMPT, which is bound to the model once.
         """
+        period_months = analysis_data.get('analysis_period_months', 3)
         
-        return prompt
+        template = _PROMPT_TEMPLATE_3MO if period_months == 3 else _PROMPT_TEMPLATE
+        return template.substitute(
+            period_months=period_months,
+            current_spending_json=_dumps(analysis_data['current_spending']),
+            monthly_spending_json=_dumps(analysis_data.get('monthly_spending', {})),
+            category_trends_json=_dumps(analysis_data.get('category_trends', {})),
+            budget_status=self._format_budget_status(analysis_data['budget_status']),
+            predictions_json=_dumps(analysis_data['predictions']),
+            total_current=f"{analysis_data['total_current_spending']:.2f}",
+            total_period=f"{analysis_data.get('total_three_month_spending', 0):.2f}",
+            average_monthly=f"{analysis_data.get('average_monthly_spending', 0):.2f}",
+            total_predicted=f"{analysis_data['total_predicted_spending']:.2f}",
+        )
+    
+    def _format_budget_status(self, budget_status: Dict[str, Dict[str, Any]]) -> str:
+        """Render budget status as one 'category:spent/limit' line per budget"""
+        return "\n".join(
+            f"{category}:{b['spent']:.0f}/{b['limit']:.0f} ({b['percentage']:.0f}%, {b['status']})"
+            for category, b in budget_status.items()
+        ) or "none"
     
     def _parse_advice_response(self, response_text: str) -> Dict[str, Any]:
         """Parse Gemini response and extract structured advice"""
         try:
-            # Clean the response text
-            response_text = response_text.strip()
-            
-            # Remove any markdown formatting
-            if response_text.startswith('```json'):
-                response_text = response_text[7:]
-            if response_text.endswith('```'):
-                response_text = response_text[:-3]
-            
-            # Try to parse JSON
-            advice_data = json.loads(response_text)
+            # JSON mode (see _GEN_CFG) returns bare JSON without markdown fences
+            advice_data = orjson.loads(response_text)
             
             # Validate required fields
             required_fields = ['summary', 'concerns', 'recommendations', 'positive_feedback', 'confidence_score']
@@ -306,40 +650,25 @@ class AdviceService:
     
     def _get_default_value(self, field: str) -> Any:
         """Get default value for missing fields"""
-        defaults = {
-            'summary': 'Unable to analyze financial data at this time.',
-            'concerns': ['Unable to identify specific concerns'],
-            'recommendations': [{
-                'title': 'Review your spending',
-                'description': 'Take time to review your recent transactions and identify areas for improvement.',
-                'priority': 'medium',
-                'potential_savings': 'Variable'
-            }],
-            'positive_feedback': ['You are actively tracking your finances, which is a great start!'],
-            'confidence_score': 50,
-            'next_steps': ['Continue monitoring your spending patterns']
-        }
-        return defaults.get(field, '')
+        return _FIELD_DEFAULTS.get(field, '')
     
     def _extract_advice_from_text(self, text: str) -> Dict[str, Any]:
         """Extract advice from unstructured text response"""
-        import re
-        
         # Extract summary (first paragraph)
-        summary_match = re.search(r'^(.+?)(?:\n\n|\n[A-Z]|$)', text, re.MULTILINE | re.DOTALL)
+        summary_match = _SUMMARY_RE.search(text)
         summary = summary_match.group(1).strip() if summary_match else "Financial analysis completed."
         
         # Extract concerns (look for keywords)
         concerns = []
         concern_keywords = ['over budget', 'exceed', 'high spending', 'concern', 'warning']
+        text_lower = text.lower()
         for keyword in concern_keywords:
-            if keyword.lower() in text.lower():
+            if keyword in text_lower:
                 concerns.append(f"Potential issue detected: {keyword}")
         
         # Extract recommendations (look for numbered lists or bullet points)
         recommendations = []
-        rec_pattern = r'(?:^|\n)(?:\d+\.|\*|\-)\s*(.+?)(?:\n|$)'
-        rec_matches = re.findall(rec_pattern, text, re.MULTILINE)
+        rec_matches = _REC_RE.findall(text)
         for i, match in enumerate(rec_matches[:5]):  # Limit to 5 recommendations
             recommendations.append({
                 'title': f'Recommendation {i+1}',
@@ -368,38 +697,24 @@ class AdviceService:
     
     def _get_fallback_advice(self) -> Dict[str, Any]:
         """Get fallback advice when Gemini is unavailable"""
-        return {
-            'summary': 'Your financial data has been analyzed. Here are some general recommendations to help improve your financial health.',
-            'concerns': ['Unable to analyze specific concerns at this time'],
-            'recommendations': [
-                {
-                    'title': 'Track Your Expenses',
-                    'description': 'Continue recording all your transactions to get better insights into your spending patterns.',
-                    'priority': 'high',
-                    'potential_savings': 'Helps identify saving opportunities'
-                },
-                {
-                    'title': 'Review Your Budget',
-                    'description': 'Regularly check your budget against actual spending to ensure you stay on track.',
-                    'priority': 'high',
-                    'potential_savings': 'Prevents overspending'
-                },
-                {
-                    'title': 'Set Financial Goals',
-                    'description': 'Define clear financial objectives to stay motivated and focused.',
-                    'priority': 'medium',
-                    'potential_savings': 'Long-term financial improvement'
-                }
-            ],
-            'positive_feedback': ['You are actively managing your finances by using this platform.'],
-            'confidence_score': 40,
-            'next_steps': ['Continue using the platform regularly for better insights.']
-        }
+        return dict(_FALLBACK_ADVICE)
     
     def generate_category_advice(self, category: str, spending_amount: float, 
                                budget_limit: float = None) -> Dict[str, Any]:
         """Generate specific advice for a spending category"""
         try:
+            # Comfortably under budget: canned advice is as good as a model call
+            if budget_limit and spending_amount < budget_limit * 0.5:
+                return {
+                    "success": True,
+                    "category": category,
+                    "recommendations": [
+                        f"You have used {spending_amount / budget_limit * 100:.0f}% of your {category} budget - keep it up",
+                        f"Consider moving part of your unused {category} budget into savings",
+                        f"Keep tracking your {category} expenses to stay on course"
+                    ]
+                }
+            
             prompt = f"""
             Provide specific financial advice for someone who spent ₹{spending_amount:.2f} on {category}.
             {"Their budget limit for this category is ₹" + str(budget_limit) + "." if budget_limit else ""}
@@ -408,10 +723,10 @@ class AdviceService:
             Format as JSON: {{"recommendations": ["advice1", "advice2", "advice3"]}}
             """
             
-            response = self.model.generate_content(prompt)
+            response = self._generate(prompt, config=_CATEGORY_GEN_CFG, system_instruction=None)
             
             try:
-                advice_data = json.loads(response.text.strip())
+                advice_data = orjson.loads(response.text.strip())
                 return {
                     "success": True,
                     "category": category,
@@ -1,47 +1,86 @@
 import os
 import re
+import logging
 import pickle
+import tempfile
 import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS, HashingVectorizer, TfidfTransformer
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score, classification_report
 import nltk
 from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
 from nltk.stem import WordNetLemmatizer
 import joblib
+import ahocorasick
+import onnxruntime as ort
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
+from functools import lru_cache
 from typing import Dict, List, Any, Tuple
 
-# Download required NLTK data
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('punkt')
+logger = logging.getLogger(__name__)
 
-try:
-    nltk.data.find('corpora/stopwords')
-except LookupError:
-    nltk.download('stopwords')
+def _safe_nltk_download(resource: str) -> bool:
+    """Download an NLTK resource only if it is not already installed; returns whether it is available"""
+    try:
+        nltk.data.find(resource)
+        return True
+    except LookupError:
+        try:
+            nltk.download(resource.split('/')[-1], quiet=True, raise_on_error=True)
+            nltk.data.find(resource)
+            return True
+        except Exception as e:
+            logger.warning("Error downloading NLTK resource %s: %s", resource, e)
+            return False
 
+# Download required NLTK data; without it (e.g. offline) fall back to
+# scikit-learn's stop words and skip lemmatization rather than failing import
+_safe_nltk_download('corpora/stopwords')
+_HAS_WORDNET = _safe_nltk_download('corpora/wordnet')
+
+# Text preprocessing resources, built once at import
 try:
-    nltk.data.find('corpora/wordnet')
+    _STOP_WORDS = frozenset(stopwords.words('english'))
 except LookupError:
-    nltk.download('wordnet')
+    logger.warning("NLTK stopwords unavailable, using scikit-learn's English stop words")
+    _STOP_WORDS = ENGLISH_STOP_WORDS
+_lemmatize = WordNetLemmatizer().lemmatize if _HAS_WORDNET else (lambda token: token)
+_CLEAN_RE = re.compile(r'[^a-zA-Z\s]')
+
+# Below this many samples a held-out split only wastes data, so skip evaluation
+_MIN_EVAL_SAMPLES = 200
+
+# Forest size limits, only applied once there is enough data to split on; on
+# the small seed set they leave the trees too shallow to separate the classes
+_LARGE_DATA_FOREST_PARAMS = {'max_depth': 12, 'min_samples_leaf': 2}
+_SMALL_DATA_FOREST_PARAMS = {'max_depth': None, 'min_samples_leaf': 1}
 
 class CategorizationService:
     def __init__(self):
         self.model_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "category_rf.pkl")
-        self.vectorizer_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "tfidf_vectorizer.pkl")
+        self.onnx_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "category_rf.onnx")
+        self.vectorizer_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "hashing_vectorizer.pkl")
+        self.tfidf_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "tfidf_transformer.pkl")
         self.label_encoder_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "label_encoder.pkl")
+        # Number of training rows the saved model was fit on
+        self.training_state_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "training_state.pkl")
         
         self.model = None
+        self.onnx_session = None
         self.vectorizer = None
+        self.tfidf = None
         self.label_encoder = None
-        self.lemmatizer = WordNetLemmatizer()
-        self.stop_words = set(stopwords.words('english'))
+        
+        # Corrections are accumulated and the model is refit every retrain_every samples;
+        # the pending count is derived from the saved data so it survives restarts
+        # and is shared by every worker
+        self.retrain_every = max(1, int(os.getenv("CATEGORIZATION_RETRAIN_EVERY", 10)))
+        self._trained_samples = 0
         
         # Common expense categories
         self.categories = [
@@ -63,27 +102,47 @@ class CategorizationService:
             'other': []
         }
         
+        # Aho-Corasick automaton over every keyword: one pass over the text finds
+        # all keyword substrings. Each keyword maps to (priority, category) so the
+        # earliest category in category_keywords still wins.
+        self._keyword_automaton = ahocorasick.Automaton()
+        for priority, (category, keywords) in enumerate(self.category_keywords.items()):
+            for keyword in keywords:
+                if keyword not in self._keyword_automaton:
+                    self._keyword_automaton.add_word(keyword, (priority, category))
+        self._keyword_automaton.make_automaton()
+        
+        # Merchant/description pairs repeat heavily and the rules ignore the amount,
+        # so memoize the rule-based result per text pair
+        self._rule_based_cached = lru_cache(maxsize=65536)(self._rule_based_categorization)
+        
         self._load_or_initialize_model()
     
     def _load_or_initialize_model(self):
         """Load existing model or initialize new one"""
         try:
-            if os.path.exists(self.model_path) and os.path.exists(self.vectorizer_path):
-                self.model = joblib.load(self.model_path)
-                self.vectorizer = joblib.load(self.vectorizer_path)
-                self.label_encoder = joblib.load(self.label_encoder_path)
-                print("Loaded existing categorization model")
+            if (os.path.exists(self.model_path) and os.path.exists(self.vectorizer_path) and
+                os.path.exists(self.tfidf_path)):
+                self.model = joblib.load(self.model_path, mmap_mode='r')
+                self.vectorizer = joblib.load(self.vectorizer_path, mmap_mode='r')
+                self.tfidf = joblib.load(self.tfidf_path, mmap_mode='r')
+                self.label_encoder = joblib.load(self.label_encoder_path, mmap_mode='r')
+                self._load_compiled_model()
+                logger.info("Loaded existing categorization model")
             else:
                 self._initialize_model()
-                print("Initialized new categorization model")
-        except Exception as e:
-            print(f"Error loading model: {e}")
+                logger.info("Initialized new categorization model")
+        except Exception:
+            logger.exception("Error loading model")
             self._initialize_model()
     
     def _initialize_model(self):
         """Initialize new model with sample data"""
-        self.model = RandomForestClassifier(n_estimators=100, random_state=42)
-        self.vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
+        self.model = RandomForestClassifier(n_estimators=100, n_jobs=-1, random_state=42)
+        # Stateless hashing keeps the feature width fixed, so a single row can be
+        # transformed at inference without refitting; only IDF weights are learned
+        self.vectorizer = HashingVectorizer(n_features=1024, alternate_sign=False, stop_words='english', dtype=np.float32)
+        self.tfidf = TfidfTransformer()
         self.label_encoder = LabelEncoder()
         
         # Create sample training data
@@ -138,8 +197,10 @@ class CategorizationService:
         
         return pd.DataFrame(sample_transactions)
     
-    def _preprocess_text(self, text: str) -> str:
-        """Preprocess text for NLP"""
+    @staticmethod
+    @lru_cache(maxsize=131072)
+    def _preprocess_text(text: str) -> str:
+        """Preprocess text for NLP (memoized; merchant strings repeat a lot)"""
         if not text:
             return ""
         
@@ -147,78 +208,168 @@ class CategorizationService:
         text = text.lower()
         
         # Remove special characters and numbers
-        text = re.sub(r'[^a-zA-Z\s]', '', text)
+        text = _CLEAN_RE.sub('', text)
         
-        # Tokenize
-        tokens = word_tokenize(text)
+        # Tokenize: only letters and whitespace are left, so a plain split
+        # matches what the Punkt tokenizer would produce
+        tokens = text.split()
         
         # Remove stopwords and lemmatize
-        tokens = [self.lemmatizer.lemmatize(token) for token in tokens if token not in self.stop_words]
+        tokens = [_lemmatize(token) for token in tokens if token not in _STOP_WORDS]
         
         return ' '.join(tokens)
     
-    def _extract_features(self, df: pd.DataFrame) -> np.ndarray:
-        """Extract features from transaction data"""
-        # Combine merchant and description
-        df['combined_text'] = df['merchant'].fillna('') + ' ' + df['description'].fillna('')
-        df['processed_text'] = df['combined_text'].apply(self._preprocess_text)
-        
-        # TF-IDF vectorization
-        tfidf_matrix = self.vectorizer.fit_transform(df['processed_text'])
+    def _processed_text(self, df: pd.DataFrame) -> List[str]:
+        """Combine and preprocess the merchant and description columns"""
+        # Combine merchant and description, and clean them with vectorized string ops
+        cleaned = (df['merchant'].fillna('') + ' ' + df['description'].fillna('')).str.lower().str.replace(_CLEAN_RE, '', regex=True)
         
+        # Remove stopwords and lemmatize in one flat pass (same result as _preprocess_text)
+        return [
+            ' '.join(_lemmatize(token) for token in text.split() if token not in _STOP_WORDS)
+            for text in cleaned.tolist()
+        ]
+    
+    def _fit_features(self, df: pd.DataFrame) -> sp.csr_matrix:
+        """Fit the TF-IDF weights on training data and extract its features"""
+        tfidf_matrix = self.tfidf.fit_transform(self.vectorizer.transform(self._processed_text(df)))
+        return self._combine_features(tfidf_matrix, df)
+    
+    def _transform_features(self, df: pd.DataFrame) -> sp.csr_matrix:
+        """Extract features with the already fitted TF-IDF weights"""
+        tfidf_matrix = self.tfidf.transform(self.vectorizer.transform(self._processed_text(df)))
+        return self._combine_features(tfidf_matrix, df)
+    
+    def _featurize_one(self, merchant: str, description: str, amount: float) -> sp.csr_matrix:
+        """Extract features for a single transaction without building a DataFrame"""
+        text = self._preprocess_text(f"{merchant or ''} {description or ''}")
+        tfidf_row = self.tfidf.transform(self.vectorizer.transform([text]))
+        return sp.hstack([tfidf_row, sp.csr_matrix(np.array([[amount]], dtype=np.float32))], format='csr')
+    
+    def _featurize_batch(self, transactions: List[Dict[str, Any]]) -> sp.csr_matrix:
+        """Extract features for many transactions with one vectorizer call"""
+        texts = [
+            self._preprocess_text(f"{txn.get('merchant') or ''} {txn.get('description') or ''}")
+            for txn in transactions
+        ]
+        tfidf_matrix = self.tfidf.transform(self.vectorizer.transform(texts))
+        amounts = np.array([txn.get('amount') or 0 for txn in transactions], dtype=np.float32).reshape(-1, 1)
+        return sp.hstack([tfidf_matrix, sp.csr_matrix(amounts)], format='csr')
+    
+    def _combine_features(self, tfidf_matrix: sp.csr_matrix, df: pd.DataFrame) -> sp.csr_matrix:
+        """Append the amount column to the text features"""
         # Add amount as feature
-        amount_features = df['amount'].values.reshape(-1, 1)
+        amount_features = sp.csr_matrix(df['amount'].values.astype(np.float32).reshape(-1, 1))
         
-        # Combine text and amount features
-        features = np.hstack([tfidf_matrix.toarray(), amount_features])
-        
-        return features
+        # Combine text and amount features, keeping the TF-IDF part sparse
+        return sp.hstack([tfidf_matrix, amount_features], format='csr')
     
     def _train_model(self, df: pd.DataFrame):
         """Train the Random Forest model"""
         try:
-            # Extract features
-            X = self._extract_features(df)
+            # Extract features; the forest fits on column-major sparse input, so
+            # convert once here rather than letting sklearn copy it on fit
+            X = self._fit_features(df).tocsc()
+            X.sort_indices()
             y = df['category'].values
             
             # Encode labels
             y_encoded = self.label_encoder.fit_transform(y)
             
-            # Split data
-            X_train, X_test, y_train, y_test = train_test_split(
-                X, y_encoded, test_size=0.2, random_state=42
-            )
-            
-            # Train model
-            self.model.fit(X_train, y_train)
-            
-            # Evaluate
-            y_pred = self.model.predict(X_test)
-            accuracy = accuracy_score(y_test, y_pred)
-            print(f"Model accuracy: {accuracy:.3f}")
+            if len(df) >= _MIN_EVAL_SAMPLES:
+                self.model.set_params(**_LARGE_DATA_FOREST_PARAMS)
+                
+                # Split data
+                X_train, X_test, y_train, y_test = train_test_split(
+                    X, y_encoded, test_size=0.2, random_state=42
+                )
+                
+                # Train model
+                self.model.fit(X_train, y_train)
+                
+                # Evaluate
+                y_pred = self.model.predict(X_test)
+                accuracy = accuracy_score(y_test, y_pred)
+                logger.info("Model accuracy: %.3f", accuracy)
+            else:
+                # Train on everything we have
+                self.model.set_params(**_SMALL_DATA_FOREST_PARAMS)
+                self.model.fit(X, y_encoded)
             
             # Save model
+            self._trained_samples = len(df)
             self._save_model()
+            self._compile_model()
             
+        except Exception:
+            logger.exception("Error training model")
+    
+    def _compile_model(self):
+        """Export the trained forest to ONNX and load it into an ONNX Runtime session"""
+        try:
+            onnx_model = convert_sklearn(
+                self.model,
+                initial_types=[('input', FloatTensorType([None, self.model.n_features_in_]))],
+                options={id(self.model): {'zipmap': False}}
+            )
+            os.makedirs(os.path.dirname(self.onnx_path), exist_ok=True)
+            with open(self.onnx_path, 'wb') as f:
+                f.write(onnx_model.SerializeToString())
+            self.onnx_session = ort.InferenceSession(self.onnx_path, providers=['CPUExecutionProvider'])
         except Exception as e:
-            print(f"Error training model: {e}")
+            self.onnx_session = None
+            logger.exception("Error compiling model")
+    
+    def _load_compiled_model(self):
+        """Load the ONNX export of the forest, re-exporting it if missing or stale"""
+        if (os.path.exists(self.onnx_path) and
+            os.path.getmtime(self.onnx_path) >= os.path.getmtime(self.model_path)):
+            try:
+                self.onnx_session = ort.InferenceSession(self.onnx_path, providers=['CPUExecutionProvider'])
+                return
+            except Exception:
+                logger.exception("Error loading compiled model")
+        self._compile_model()
+    
+    def _predict_proba(self, X: sp.csr_matrix) -> np.ndarray:
+        """Class probabilities, from the compiled ONNX forest when it is available"""
+        if self.onnx_session is not None:
+            return self.onnx_session.run(['probabilities'], {'input': X.toarray().astype(np.float32, copy=False)})[0]
+        return self.model.predict_proba(X)
     
     def _save_model(self):
         """Save trained model and components"""
         try:
             os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
-            joblib.dump(self.model, self.model_path)
-            joblib.dump(self.vectorizer, self.vectorizer_path)
-            joblib.dump(self.label_encoder, self.label_encoder_path)
-            print("Model saved successfully")
-        except Exception as e:
-            print(f"Error saving model: {e}")
+            self._dump_artifact(self.model, self.model_path)
+            self._dump_artifact(self.vectorizer, self.vectorizer_path)
+            self._dump_artifact(self.tfidf, self.tfidf_path)
+            self._dump_artifact(self.label_encoder, self.label_encoder_path)
+            self._dump_artifact({'trained_samples': self._trained_samples}, self.training_state_path)
+            logger.info("Model saved successfully")
+        except Exception:
+            logger.exception("Error saving model")
+    
+    @staticmethod
+    def _dump_artifact(obj: Any, path: str):
+        """Dump uncompressed so the arrays can be memory-mapped on load"""
+        # Write to a temp file and swap it in: truncating a file that is
+        # still memory-mapped would pull the pages out from under the loader.
+        # The temp name is unique so concurrent workers never share one.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        try:
+            joblib.dump(obj, tmp_path, compress=0)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
     
     def categorize(self, merchant: str = None, description: str = None, amount: float = 0) -> Dict[str, Any]:
         """Categorize a transaction"""
         try:
             # Rule-based categorization first
-            rule_based_category = self._rule_based_categorization(merchant, description)
+            rule_based_category = self._rule_based_cached(merchant, description)
             if rule_based_category and rule_based_category != 'other':
                 return {
                     "category": rule_based_category,
@@ -227,25 +378,17 @@ class CategorizationService:
                 }
             
             # ML-based categorization
-            if self.model and self.vectorizer and self.label_encoder:
-                # Prepare data
-                data = pd.DataFrame([{
-                    'merchant': merchant or '',
-                    'description': description or '',
-                    'amount': amount,
-                    'category': 'unknown'
-                }])
-                
+            if self.model and self.vectorizer and self.tfidf and self.label_encoder:
                 # Extract features
-                X = self._extract_features(data)
+                X = self._featurize_one(merchant, description, amount)
                 
-                # Predict
-                prediction = self.model.predict(X)[0]
-                probabilities = self.model.predict_proba(X)[0]
+                # Predict (predict() is just the argmax of predict_proba)
+                probabilities = self._predict_proba(X)[0]
+                best = probabilities.argmax()
                 
                 # Get category name
-                category = self.label_encoder.inverse_transform([prediction])[0]
-                confidence = max(probabilities)
+                category = self.label_encoder.inverse_transform([self.model.classes_[best]])[0]
+                confidence = probabilities[best]
                 
                 return {
                     "category": category,
@@ -260,22 +403,74 @@ class CategorizationService:
                 "method": "fallback"
             }
             
-        except Exception as e:
-            print(f"Error in categorization: {e}")
+        except Exception:
+            logger.exception("Error in categorization")
             return {
                 "category": "other",
                 "confidence": 0.3,
                 "method": "error_fallback"
             }
     
+    def categorize_batch(self, transactions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Categorize a list of transactions, running the ML model once for all of them"""
+        try:
+            results = [None] * len(transactions)
+            
+            # Rule-based categorization first
+            pending = []
+            for i, txn in enumerate(transactions):
+                rule_based_category = self._rule_based_cached(txn.get('merchant'), txn.get('description'))
+                if rule_based_category and rule_based_category != 'other':
+                    results[i] = {
+                        "category": rule_based_category,
+                        "confidence": 0.9,
+                        "method": "rule_based"
+                    }
+                else:
+                    pending.append(i)
+            
+            if not pending:
+                return results
+            
+            # ML-based categorization for everything the rules did not match
+            if self.model and self.vectorizer and self.tfidf and self.label_encoder:
+                X = self._featurize_batch([transactions[i] for i in pending])
+                probabilities = self._predict_proba(X)
+                best = probabilities.argmax(axis=1)
+                categories = self.label_encoder.inverse_transform(self.model.classes_[best])
+                confidences = probabilities[np.arange(len(best)), best]
+                
+                for i, category, confidence in zip(pending, categories, confidences):
+                    results[i] = {
+                        "category": category,
+                        "confidence": float(confidence),
+                        "method": "ml_model"
+                    }
+                return results
+            
+            # Fallback
+            for i in pending:
+                results[i] = {
+                    "category": "other",
+                    "confidence": 0.5,
+                    "method": "fallback"
+                }
+            return results
+            
+        except Exception:
+            logger.exception("Error in batch categorization")
+            return [
+                {"category": "other", "confidence": 0.3, "method": "error_fallback"}
+                for _ in transactions
+            ]
+    
     def _rule_based_categorization(self, merchant: str, description: str) -> str:
         """Rule-based categorization using keywords"""
         text = f"{merchant or ''} {description or ''}".lower()
         
-        for category, keywords in self.category_keywords.items():
-            for keyword in keywords:
-                if keyword in text:
-                    return category
+        matches = [value for _, value in self._keyword_automaton.iter(text)]
+        if matches:
+            return min(matches)[1]
         
         return "other"
     
@@ -301,6 +496,18 @@ class CategorizationService:
             except:
                 combined_data = new_data
             
+            # Persist the correction so it survives restarts
+            self._save_training_data(combined_data)
+            pending_samples = len(combined_data) - self._saved_trained_samples()
+            
+            # Only refit once enough corrections have accumulated
+            if pending_samples < self.retrain_every:
+                return {
+                    "success": True,
+                    "message": f"Training sample saved, model will retrain after {self.retrain_every - pending_samples} more",
+                    "new_samples": len(combined_data)
+                }
+            
             # Retrain model
             self._train_model(combined_data)
             
@@ -316,19 +523,34 @@ class CategorizationService:
                 "error": str(e)
             }
     
+    def _saved_trained_samples(self) -> int:
+        """Training rows behind the model on disk, which may have been refit by another worker"""
+        try:
+            return joblib.load(self.training_state_path)['trained_samples']
+        except Exception:
+            # Saved by an older version without the count: treat every row as pending
+            return 0
+    
     def _load_training_data(self) -> pd.DataFrame:
         """Load existing training data from file"""
-        training_data_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "training_data.pkl")
+        model_dir = os.getenv("MODEL_PATH", "../models")
+        training_data_path = os.path.join(model_dir, "training_data.parquet")
         try:
-            return joblib.load(training_data_path)
+            return pd.read_parquet(training_data_path, columns=['merchant', 'description', 'amount', 'category'])
+        except:
+            pass
+        
+        # Fall back to data saved by older versions as a pickle
+        try:
+            return joblib.load(os.path.join(model_dir, "training_data.pkl"))
         except:
             return self._create_sample_data()
     
     def _save_training_data(self, df: pd.DataFrame):
         """Save training data"""
-        training_data_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "training_data.pkl")
+        training_data_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "training_data.parquet")
         try:
             os.makedirs(os.path.dirname(training_data_path), exist_ok=True)
-            joblib.dump(df, training_data_path)
-        except Exception as e:
-            print(f"Error saving training data: {e}")
+            df.to_parquet(training_data_path, compression='snappy', index=False)
+        except Exception:
+            logger.exception("Error saving training data")
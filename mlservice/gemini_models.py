@@ -0,0 +1,4 @@
+# Gemini 1.0 models (gemini-1.0-*, gemini-pro, gemini-pro-vision) reject
+# system instructions, which both the OCR and advice prompts are sent as, and
+# JSON mode, which the advice requests use; they are never used as candidates
+UNSUPPORTED_MODEL_PREFIXES = ('gemini-1.0-', 'gemini-pro')
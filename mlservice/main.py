@@ -1,12 +1,18 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
+import google.generativeai as genai
 import os
-import json
+import orjson
+import logging
+import logging.handlers
+import queue
 from dotenv import load_dotenv
 from pathlib import Path
+from contextlib import asynccontextmanager
+from typing import List
 
 from ocr_service import OCRService
 from categorization_service import CategorizationService
@@ -17,10 +23,53 @@ from advice_service import AdviceService
 _env_path = Path(__file__).with_name('.env')
 load_dotenv(dotenv_path=_env_path, override=True)
 
+# Configure Gemini once per process; genai.configure replaces the SDK's global
+# client state, so the services must not call it themselves. Every model then
+# shares the SDK's default async client and its grpc_asyncio channel ("rest"
+# has no async client for generate_content_async).
+if os.getenv("GEMINI_API_KEY"):
+    genai.configure(
+        api_key=os.getenv("GEMINI_API_KEY"),
+        client_options={"api_endpoint": os.getenv("GEMINI_API_ENDPOINT", "generativelanguage.googleapis.com")}
+    )
+
+# Log through a queue so request handlers never block on stderr writes. The
+# QueueHandler merges the message and any traceback on the calling thread; the
+# listener thread adds the timestamp, level and logger name and writes it out.
+_log_queue = queue.SimpleQueue()
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the heavy models once per worker at startup instead of on the first request
+    try:
+        get_categorization_service()
+        get_prediction_service().ensure_model()
+        if os.getenv("GEMINI_API_KEY"):
+            advice = get_advice_service()
+            # Discover the candidate models now rather than on the first request
+            await advice.resolve_model_names()
+            # The warmup is a billed request per worker, so it is opt-in
+            if os.getenv("ADVICE_WARMUP", "false").lower() == "true":
+                await advice.warmup()
+    except Exception:
+        logger.exception("Error warming up services")
+    yield
+    _log_listener.stop()
+
 app = FastAPI(
     title="AI Finance ML Service",
     description="Machine Learning service for AI Finance Platform",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -120,6 +169,16 @@ async def categorize_transaction(request: CategorizeRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/categorize/batch")
+async def categorize_transactions(requests: List[CategorizeRequest]):
+    try:
+        result = get_categorization_service().categorize_batch(
+            [request.model_dump() for request in requests]
+        )
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/train")
 async def train_model(request: TrainRequest):
     try:
@@ -147,11 +206,22 @@ async def predict_spending(request: PredictRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/predict/batch")
+async def predict_spending_batch(requests: List[PredictRequest]):
+    try:
+        result = get_prediction_service().predict_spending_batch([
+            (request.user_id, request.spending_data, request.target_month, request.target_year)
+            for request in requests
+        ])
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Advice endpoints
 @app.post("/advice")
 async def generate_advice(request: AdviceRequest):
     try:
-        result = get_advice_service().generate_advice(
+        result = await get_advice_service().generate_advice_async(
             current_spending=request.current_spending,
             monthly_spending=request.monthly_spending,
             budgets=request.budgets,
@@ -168,7 +238,7 @@ async def generate_advice_stream(request: AdviceRequest):
     """Stream advice generation as it's being created"""
     async def generate():
         try:
-            for chunk in get_advice_service().generate_advice_stream(
+            async for chunk in get_advice_service().generate_advice_stream_async(
                 current_spending=request.current_spending,
                 monthly_spending=request.monthly_spending,
                 budgets=request.budgets,
@@ -176,9 +246,9 @@ async def generate_advice_stream(request: AdviceRequest):
                 user_id=request.user_id,
                 analysis_period_months=request.analysis_period_months
             ):
-                yield f"data: {json.dumps(chunk)}\n\n"
+                yield b"data: " + orjson.dumps(chunk, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n\n"
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+            yield b"data: " + orjson.dumps({'type': 'error', 'error': str(e)}) + b"\n\n"
     
     return StreamingResponse(generate(), media_type="text/event-stream")
 
@@ -191,5 +261,6 @@ if __name__ == "__main__":
         "main:app",
         host="0.0.0.0",
         port=int(os.getenv("ML_SERVICE_PORT", 8000)),
-        reload=True
+        reload=os.getenv("ML_RELOAD", "false").lower() == "true",
+        workers=int(os.getenv("ML_WORKERS", 1))
     )
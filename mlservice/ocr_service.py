@@ -1,11 +1,114 @@
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
+import asyncio
 import os
+import io
 import json
 import re
+import logging
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from pathlib import Path
 import aiofiles
+from PIL import Image, ImageOps
+
+from gemini_models import UNSUPPORTED_MODEL_PREFIXES
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on a single Gemini call, in seconds
+_GENERATE_TIMEOUT = 30
+
+# Retry policy for Gemini rate limiting (429): a full pass over the models is
+# retried after 10s, 20s, 40s, ... until the total wait would exceed the cap
+_BACKOFF_SECONDS = 10
+_MAX_BACKOFF_SECONDS = 70
+
+# Receipt images are downscaled to this bounding box and re-encoded as JPEG
+_MAX_IMAGE_DIM = 1280
+_JPEG_QUALITY = 85
+
+# Fallback extraction patterns, tried in order
+_MERCHANT_RE = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r"merchant[:\s]+([^\n]+)",
+    r"store[:\s]+([^\n]+)",
+    r"company[:\s]+([^\n]+)",
+))
+_DATE_RE = tuple(re.compile(p) for p in (
+    r"(\d{4}-\d{2}-\d{2})",        # YYYY-MM-DD
+    r"(\d{2}/\d{2}/\d{4})",        # MM/DD/YYYY
+    r"(\d{1,2}/\d{1,2}/\d{4})",    # M/D/YYYY
+    r"(\d{2}-\d{2}-\d{4})",        # DD-MM-YYYY
+    r"(\d{1,2}-\d{1,2}-\d{4})",    # D-M-YYYY
+))
+_AMOUNT_RE = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r"total[:\s]+(?:rs\.?\s*|₹\s*|\$\s*)?([\d,]+\.?\d*)",
+    r"amount[:\s]+(?:rs\.?\s*|₹\s*|\$\s*)?([\d,]+\.?\d*)",
+    r"[₹$]([\d,]+\.?\d*)",
+    r"rs\.?\s*([\d,]+\.?\d*)",
+))
+
+# Currency symbols and thousands separators stripped before parsing amounts
+_CURRENCY_TRANS = str.maketrans("", "", "₹$,")
+_RS_RE = re.compile(r'rs\.?', re.IGNORECASE)
+
+# Fixed receipt-extraction instructions, passed to the model as its system
+# instruction so the user turn holds only the image. Gemini still sends and
+# bills the instruction with every request.
+_RECEIPT_SYSTEM_PROMPT = """Analyze this receipt image and extract the following information in JSON format ONLY (no prose, no markdown):
+{
+    "merchant": "store/company name",
+    "date": "YYYY-MM-DD",
+    "total_amount": "total amount as number",
+    "items": [
+        {
+            "description": "item description",
+            "amount": "item amount as number"
+        }
+    ],
+    "category": "likely expense category (food, transportation, shopping, entertainment, etc.)",
+    "confidence": "confidence score 0-1"
+}
+
+Rules:
+- Extract merchant name from header/top of receipt
+- Extract date in YYYY-MM-DD format (convert if printed as MM/DD/YYYY or DD-MM-YYYY)
+- Extract total amount (usually at bottom)
+- List main items purchased
+- Suggest appropriate category based on merchant and items
+- Return only valid JSON, no additional text
+"""
+
+def _find_json_object(text: str) -> Optional[str]:
+    """Return the first balanced top-level {...} object in text, skipping braces inside strings"""
+    start = text.find('{')
+    if start == -1:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+def _parse_money(value: Any) -> float:
+    """Parse an amount such as 'Rs. 1,250' or '$12.50' into a positive float"""
+    return abs(float(_RS_RE.sub("", str(value).translate(_CURRENCY_TRANS))))
 
 class OCRService:
     def __init__(self):
@@ -13,17 +116,29 @@ class OCRService:
         if not self.api_key:
             raise ValueError("GEMINI_API_KEY environment variable is required")
         
-        genai.configure(api_key=self.api_key)
-        # Dynamically detect an available vision-capable model that supports generateContent
-        self.model_names = self._detect_vision_models()
-        if not self.model_names:
-            # Reasonable fallbacks
-            self.model_names = [
-                "gemini-1.5-flash",
-                "gemini-1.5-flash-latest",
-                "gemini-1.0-pro-vision",
-            ]
-        print(f"[OCR] Model candidates: {self.model_names}")
+        # Known vision-capable models in order of preference; list_models() is only
+        # consulted if every one of these fails
+        self.model_names = [
+            "gemini-1.5-flash",
+            "gemini-1.5-flash-latest",
+            "gemini-1.5-pro",
+        ]
+        self._discovered = False
+        logger.info("Model candidates: %s", self.model_names)
+        self.persist_uploads = os.getenv("OCR_PERSIST_UPLOADS", "false").lower() == "true"
+        # Cap concurrent Gemini calls to stay under the API rate limits
+        self._sem = asyncio.Semaphore(int(os.getenv("OCR_CONCURRENCY", 5)))
+        # Strong references so in-flight persistence tasks are not garbage collected
+        self._persist_tasks = set()
+        # Build the model clients once instead of on every receipt
+        self.models = self._build_models(self.model_names)
+
+    @staticmethod
+    def _build_models(names):
+        return [
+            genai.GenerativeModel(name, system_instruction=_RECEIPT_SYSTEM_PROMPT)
+            for name in names
+        ]
 
     def _detect_vision_models(self):
         try:
@@ -36,8 +151,8 @@ class OCRService:
                     name = name.split('models/')[-1]
                 methods = set(getattr(m, 'supported_generation_methods', []) or [])
                 if ('generateContent' in methods) and (
-                    'vision' in name or 'flash' in name or 'pro-vision' in name
-                ):
+                    'vision' in name or 'flash' in name
+                ) and not name.startswith(UNSUPPORTED_MODEL_PREFIXES):
                     names.append(name)
             # Prefer 1.5 flash variants first
             names.sort(key=lambda n: (
@@ -49,88 +164,119 @@ class OCRService:
         except Exception:
             return []
         
+    async def _generate_with_fallback(self, parts: list):
+        """Try each model once in turn; returns (response, last_error, rate_limited)"""
+        response = None
+        last_err = None
+        rate_limited = False
+        for model in self.models:
+            try:
+                response = await asyncio.wait_for(model.generate_content_async(parts), timeout=_GENERATE_TIMEOUT)
+                if response and getattr(response, 'text', None):
+                    break
+            except ResourceExhausted as e:
+                rate_limited = True
+                last_err = e
+            except Exception as e:
+                last_err = e
+        return response, last_err, rate_limited
+
+    async def _generate(self, parts: list):
+        """Run the model fallback pass, backing off while the quota is exhausted"""
+        waited = 0
+        delay = _BACKOFF_SECONDS
+        while True:
+            async with self._sem:
+                response, last_err, rate_limited = await self._generate_with_fallback(parts)
+                # Unknown model names fail without a 429; refresh the list once and retry
+                if response is None and not rate_limited and await self._rediscover_models():
+                    response, last_err, rate_limited = await self._generate_with_fallback(parts)
+            if response is not None or not rate_limited or waited + delay > _MAX_BACKOFF_SECONDS:
+                return response, last_err
+            # The quota is shared by every model, so wait before the next pass;
+            # the semaphore is released so other receipts are not held up meanwhile
+            await asyncio.sleep(delay)
+            waited += delay
+            delay *= 2
+
+    async def _rediscover_models(self) -> bool:
+        """Replace the model list with what list_models() reports, once per process"""
+        if self._discovered:
+            return False
+        self._discovered = True
+        names = await asyncio.to_thread(self._detect_vision_models)
+        if not names or names == self.model_names:
+            return False
+        self.model_names = names
+        self.models = self._build_models(names)
+        logger.info("Model candidates (discovered): %s", self.model_names)
+        return True
+
+    @staticmethod
+    def _downscale_image(data: bytes) -> bytes:
+        """Shrink an image to fit _MAX_IMAGE_DIM and re-encode it as JPEG"""
+        with Image.open(io.BytesIO(data)) as img:
+            # The EXIF tag is not carried over, so rotate phone photos upright first
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((_MAX_IMAGE_DIM, _MAX_IMAGE_DIM), Image.LANCZOS)
+            out = io.BytesIO()
+            img.convert("RGB").save(out, format="JPEG", quality=_JPEG_QUALITY, optimize=True)
+        return out.getvalue()
+
+    async def _persist_upload(self, data: bytes, save_path: Path):
+        """Write an uploaded receipt to disk"""
+        try:
+            save_path.parent.mkdir(parents=True, exist_ok=True)
+            async with aiofiles.open(save_path, 'wb') as out:
+                await out.write(data)
+        except Exception:
+            logger.exception("Failed to persist upload %s", save_path)
+
     async def extract_receipt_data(self, file: Any) -> Dict[str, Any]:
         """Extract structured data from receipt image using Gemini Vision API"""
         try:
-            # Persist upload to disk so the SDK can read by path
-            upload_dir = Path(os.getenv("UPLOAD_DIR", "uploads"))
-            upload_dir.mkdir(parents=True, exist_ok=True)
+            # Read the upload straight into memory; the image is sent inline
+            buf = bytearray()
+            while chunk := await file.read(1024 * 1024):
+                buf.extend(chunk)
+            file_bytes = bytes(buf)
             suffix = Path(file.filename).suffix or ".jpg"
-            safe_name = f"receipt_{int(datetime.now().timestamp())}{suffix}"
-            save_path = upload_dir / safe_name
 
-            async with aiofiles.open(save_path, 'wb') as out:
-                while True:
-                    chunk = await file.read(1024 * 1024)
-                    if not chunk:
-                        break
-                    await out.write(chunk)
+            # Keeping a copy on disk is optional and never holds up the Gemini call
+            if self.persist_uploads:
+                upload_dir = Path(os.getenv("UPLOAD_DIR", "uploads"))
+                save_path = upload_dir / f"receipt_{int(datetime.now().timestamp())}{suffix}"
+                task = asyncio.create_task(self._persist_upload(file_bytes, save_path))
+                self._persist_tasks.add(task)
+                task.add_done_callback(self._persist_tasks.discard)
 
             # Prepare image/file part for Gemini (compat with older SDKs without upload_file)
-            ext = save_path.suffix.lower()
+            ext = suffix.lower()
             mime = 'image/png'
             if ext in ['.jpg', '.jpeg']:
                 mime = 'image/jpeg'
             elif ext == '.pdf':
                 mime = 'application/pdf'
 
-            with open(save_path, 'rb') as f:
-                file_bytes = f.read()
-            image_part = {"mime_type": mime, "data": file_bytes}
-            
-            # Create prompt for receipt extraction
-            prompt = """
-            Analyze this receipt image and extract the following information in JSON format ONLY (no prose, no markdown):
-            {
-                "merchant": "store/company name",
-                "date": "YYYY-MM-DD",
-                "total_amount": "total amount as number",
-                "items": [
-                    {
-                        "description": "item description",
-                        "amount": "item amount as number"
-                    }
-                ],
-                "category": "likely expense category (food, transportation, shopping, entertainment, etc.)",
-                "confidence": "confidence score 0-1"
-            }
-            
-            Rules:
-            - Extract merchant name from header/top of receipt
-            - Extract date in YYYY-MM-DD format (convert if printed as MM/DD/YYYY or DD-MM-YYYY)
-            - Extract total amount (usually at bottom)
-            - List main items purchased
-            - Suggest appropriate category based on merchant and items
-            - Return only valid JSON, no additional text
-            """
-            
-            # Generate content with fallback across known model names
-            response = None
-            last_err = None
-            for name in self.model_names:
+            # Phone photos are far larger than the model needs; send a smaller JPEG
+            if mime.startswith("image/"):
                 try:
-                    model = genai.GenerativeModel(name)
-                    response = model.generate_content([prompt, image_part])
-                    if response and getattr(response, 'text', None):
-                        break
+                    file_bytes = await asyncio.to_thread(self._downscale_image, file_bytes)
+                    mime = 'image/jpeg'
                 except Exception as e:
-                    last_err = e
-                    continue
+                    logger.warning("Image downscale failed, sending original: %s", e)
+
+            image_part = {"mime_type": mime, "data": file_bytes}
+
+            # Generate content with fallback across known model names
+            response, last_err = await self._generate([image_part])
             if response is None:
                 raise RuntimeError(str(last_err) if last_err else "OCR model generation failed")
             
             # Parse JSON response
             try:
-                # Clean the response text
-                response_text = response.text.strip()
-                
-                # Remove any markdown formatting
-                if response_text.startswith('```json'):
-                    response_text = response_text[7:]
-                if response_text.endswith('```'):
-                    response_text = response_text[:-3]
-                
-                extracted_data = json.loads(response_text)
+                # Pull the JSON object out of any surrounding prose or markdown fences
+                extracted_data = json.loads(_find_json_object(response.text) or response.text)
                 
                 # Validate and clean the data
                 cleaned_data = self._clean_extracted_data(extracted_data)
@@ -195,8 +341,7 @@ class OCRService:
         # Clean total amount
         if "total_amount" in data:
             try:
-                amount = float(str(data["total_amount"]).replace("₹", "").replace("$", "").replace(",", "").replace("rs", "").replace("RS", "").replace("Rs", ""))
-                cleaned["total_amount"] = abs(amount)  # Make sure it's positive
+                cleaned["total_amount"] = _parse_money(data["total_amount"])
             except ValueError:
                 cleaned["total_amount"] = 0.0
         
@@ -210,8 +355,7 @@ class OCRService:
                         cleaned_item["description"] = str(item["description"]).strip()
                     if "amount" in item:
                         try:
-                            amount = float(str(item["amount"]).replace("₹", "").replace("$", "").replace(",", "").replace("rs", "").replace("RS", "").replace("Rs", ""))
-                            cleaned_item["amount"] = abs(amount)
+                            cleaned_item["amount"] = _parse_money(item["amount"])
                         except ValueError:
                             cleaned_item["amount"] = 0.0
                     cleaned["items"].append(cleaned_item)
@@ -235,44 +379,20 @@ class OCRService:
         cleaned_data = {}
         
         # Extract merchant (look for common patterns)
-        merchant_patterns = [
-            r"merchant[:\s]+([^\n]+)",
-            r"store[:\s]+([^\n]+)",
-            r"company[:\s]+([^\n]+)"
-        ]
-        
-        for pattern in merchant_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
+        for pattern in _MERCHANT_RE:
+            if (match := pattern.search(text)):
                 cleaned_data["merchant"] = match.group(1).strip()
                 break
         
         # Extract date
-        date_patterns = [
-            r"(\d{4}-\d{2}-\d{2})",        # YYYY-MM-DD
-            r"(\d{2}/\d{2}/\d{4})",        # MM/DD/YYYY
-            r"(\d{1,2}/\d{1,2}/\d{4})",    # M/D/YYYY
-            r"(\d{2}-\d{2}-\d{4})",        # DD-MM-YYYY
-            r"(\d{1,2}-\d{1,2}-\d{4})"     # D-M-YYYY
-        ]
-        
-        for pattern in date_patterns:
-            match = re.search(pattern, text)
-            if match:
+        for pattern in _DATE_RE:
+            if (match := pattern.search(text)):
                 cleaned_data["date"] = match.group(1)
                 break
         
         # Extract total amount
-        amount_patterns = [
-            r"total[:\s]+(?:rs\.?\s*|₹\s*|\$\s*)?([\d,]+\.?\d*)",
-            r"amount[:\s]+(?:rs\.?\s*|₹\s*|\$\s*)?([\d,]+\.?\d*)",
-            r"[₹$]([\d,]+\.?\d*)",
-            r"rs\.?\s*([\d,]+\.?\d*)"
-        ]
-        
-        for pattern in amount_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
+        for pattern in _AMOUNT_RE:
+            if (match := pattern.search(text)):
                 try:
                     amount = float(match.group(1).replace(",", ""))
                     cleaned_data["total_amount"] = abs(amount)
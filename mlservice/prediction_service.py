@@ -2,52 +2,117 @@ import os
 import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Dict, List, Any, Tuple
 import joblib
+import tempfile
+import threading
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.metrics import mean_absolute_error, mean_squared_error
-import tensorflow as tf
-from tensorflow.keras.models import Sequential, load_model
-from tensorflow.keras.layers import LSTM, Dense, Dropout
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
+import logging
 import warnings
 warnings.filterwarnings('ignore')
 
+logger = logging.getLogger(__name__)
+
+# int8 calibration uses up to this many training sequences, and the quantized
+# model is kept only if its held-out MSE (on scaled targets) is within tolerance
+_QUANT_CALIBRATION_SAMPLES = 100
+_QUANT_MSE_TOLERANCE = 0.01
+
+# Mean and spread of the generated sample spending, in the order of the
+# default categories set in _initialize_model
+_SAMPLE_MEANS = np.array([300, 150, 200, 100, 250, 80, 50, 120, 200, 100], dtype=np.float32)
+_SAMPLE_STDS = np.array([50, 30, 80, 40, 20, 30, 20, 60, 10, 50], dtype=np.float32)
+
+# Seasonal spending multipliers per category, by calendar month
+_SEASONAL_FACTORS = {
+    'food': {11: 1.1, 12: 1.2, 1: 1.1, 6: 1.0, 7: 1.0, 8: 1.0},
+    'shopping': {11: 1.5, 12: 1.8, 1: 1.3, 6: 0.9, 7: 0.8, 8: 0.9},
+    'entertainment': {11: 1.2, 12: 1.3, 1: 1.1, 6: 1.2, 7: 1.3, 8: 1.2},
+    'travel': {6: 1.4, 7: 1.5, 8: 1.4, 11: 1.1, 12: 1.2, 1: 0.8},
+    'utilities': {12: 1.2, 1: 1.3, 2: 1.2, 6: 1.1, 7: 1.2, 8: 1.1}
+}
+
+@lru_cache(maxsize=8)
+def _seasonal_table(categories: Tuple[str, ...]) -> np.ndarray:
+    """(categories, 12) lookup table of _SEASONAL_FACTORS, 1.0 where no factor is set"""
+    table = np.ones((len(categories), 12))
+    for i, category in enumerate(categories):
+        for month, factor in _SEASONAL_FACTORS.get(category, {}).items():
+            table[i, month - 1] = factor
+    return table
+
+@lru_cache(maxsize=8)
+def _category_index(categories: Tuple[str, ...]) -> Dict[str, int]:
+    """Column index of each category in the monthly amounts matrix"""
+    return {category: i for i, category in enumerate(categories)}
+
 class PredictionService:
     def __init__(self):
         self.model_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "spend_rnn.h5")
-        self.scaler_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "spend_scaler.pkl")
-        self.categories_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "categories.pkl")
+        self.tflite_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "spend_rnn.tflite")
+        # Scalers, categories and the model file mtimes they were saved with
+        self.bundle_path = os.path.join(os.getenv("MODEL_PATH", "../models"), "spend_bundle.pkl")
         
         self.model = None
-        self.scaler = None
+        self._predict_fn = None  # traced inference graph of self.model
+        self.interpreter = None
+        self._interpreter_lock = threading.Lock()  # TFLite interpreters are not thread-safe
+        self.target_scaler = None  # scales category amounts
+        self.feature_scaler = None  # scales (month, year) inputs
         self.categories = None
         self.sequence_length = 12  # Use 12 months of data for prediction
         
-        self._load_or_initialize_model()
+        # TensorFlow and the model are loaded on first use (see ensure_model)
+        self._load_lock = threading.Lock()
+        self._load_started = False
+        self._init_thread = None
+    
+    def ensure_model(self) -> bool:
+        """Load the model on first use and report whether it is ready for inference"""
+        with self._load_lock:
+            if not self._load_started:
+                self._load_started = True
+                self._load_or_initialize_model()
+        return self.interpreter is not None or self._predict_fn is not None
     
     def _load_or_initialize_model(self):
         """Load existing model or initialize new one"""
         try:
-            if (os.path.exists(self.model_path) and 
-                os.path.exists(self.scaler_path) and 
-                os.path.exists(self.categories_path)):
-                
-                self.model = load_model(self.model_path)
-                self.scaler = joblib.load(self.scaler_path)
-                self.categories = joblib.load(self.categories_path)
-                print("Loaded existing prediction model")
+            if os.path.exists(self.model_path) and os.path.exists(self.bundle_path):
+                bundle = joblib.load(self.bundle_path, mmap_mode='r')
+                self.target_scaler = bundle["target_scaler"]
+                self.feature_scaler = bundle["feature_scaler"]
+                self.categories = bundle["categories"]
+                self._load_compiled_model(bundle)
+                logger.info("Loaded existing prediction model")
             else:
-                self._initialize_model()
-                print("Initialized new prediction model")
-        except Exception as e:
-            print(f"Error loading model: {e}")
+                self._initialize_in_background()
+        except Exception:
+            logger.exception("Error loading model")
+            self.interpreter = None
+            self._predict_fn = None
+            self._initialize_in_background()
+    
+    def _initialize_in_background(self):
+        """Train the initial model on a daemon thread; trend analysis serves predictions meanwhile"""
+        def run():
             self._initialize_model()
+            if self.interpreter is not None or self._predict_fn is not None:
+                logger.info("Initialized new prediction model")
+        
+        self.categories = self.categories or [
+            'food', 'transportation', 'shopping', 'entertainment', 'utilities',
+            'healthcare', 'education', 'travel', 'insurance', 'other'
+        ]
+        self._init_thread = threading.Thread(target=run, daemon=True)
+        self._init_thread.start()
     
     def _initialize_model(self):
         """Initialize new model with sample data"""
-        self.scaler = MinMaxScaler()
+        self.target_scaler = MinMaxScaler()
+        self.feature_scaler = MinMaxScaler()
         self.categories = [
             'food', 'transportation', 'shopping', 'entertainment', 'utilities',
             'healthcare', 'education', 'travel', 'insurance', 'other'
@@ -63,45 +128,29 @@ class PredictionService:
         start_date = datetime.now() - timedelta(days=730)
         dates = [start_date + timedelta(days=i*30) for i in range(24)]
         
-        sample_data = []
-        np.random.seed(42)
-        
-        for date in dates:
-            for category in self.categories:
-                # Generate realistic spending amounts with some randomness
-                base_amounts = {
-                    'food': 300 + np.random.normal(0, 50),
-                    'transportation': 150 + np.random.normal(0, 30),
-                    'shopping': 200 + np.random.normal(0, 80),
-                    'entertainment': 100 + np.random.normal(0, 40),
-                    'utilities': 250 + np.random.normal(0, 20),
-                    'healthcare': 80 + np.random.normal(0, 30),
-                    'education': 50 + np.random.normal(0, 20),
-                    'travel': 120 + np.random.normal(0, 60),
-                    'insurance': 200 + np.random.normal(0, 10),
-                    'other': 100 + np.random.normal(0, 50)
-                }
-                
-                # Add seasonal variations
-                month = date.month
-                if month in [11, 12, 1]:  # Holiday season
-                    base_amounts['shopping'] *= 1.5
-                    base_amounts['entertainment'] *= 1.3
-                elif month in [6, 7, 8]:  # Summer
-                    base_amounts['travel'] *= 1.4
-                    base_amounts['entertainment'] *= 1.2
-                
-                amount = max(0, base_amounts[category])
-                
-                sample_data.append({
-                    'date': date.strftime('%Y-%m-%d'),
-                    'category': category,
-                    'amount': amount,
-                    'month': date.month,
-                    'year': date.year
-                })
-        
-        return pd.DataFrame(sample_data)
+        # Generate realistic spending amounts with some randomness, one row per month
+        rng = np.random.default_rng(42)
+        amounts = rng.normal(_SAMPLE_MEANS, _SAMPLE_STDS, (len(dates), len(self.categories)))
+        
+        # Add seasonal variations
+        months = np.array([date.month for date in dates])
+        holiday = np.isin(months, [11, 12, 1])
+        summer = np.isin(months, [6, 7, 8])
+        multipliers = np.ones_like(amounts)
+        multipliers[holiday, self.categories.index('shopping')] = 1.5
+        multipliers[holiday, self.categories.index('entertainment')] = 1.3
+        multipliers[summer, self.categories.index('travel')] = 1.4
+        multipliers[summer, self.categories.index('entertainment')] = 1.2
+        amounts = np.clip(amounts * multipliers, 0, None)
+        
+        n_categories = len(self.categories)
+        return pd.DataFrame({
+            'date': np.repeat([date.strftime('%Y-%m-%d') for date in dates], n_categories),
+            'category': np.tile(self.categories, len(dates)),
+            'amount': amounts.ravel(),
+            'month': np.repeat(months, n_categories),
+            'year': np.repeat([date.year for date in dates], n_categories)
+        })
     
     def _prepare_data(self, df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
         """Prepare data for LSTM training"""
@@ -121,19 +170,25 @@ class PredictionService:
         targets = pivot_data[self.categories].values
         
         # Scale the data
-        features_scaled = self.scaler.fit_transform(features)
-        targets_scaled = self.scaler.fit_transform(targets)
+        features_scaled = self.feature_scaler.fit_transform(features)
+        targets_scaled = self.target_scaler.fit_transform(targets)
         
-        # Create sequences for LSTM
-        X, y = [], []
-        for i in range(self.sequence_length, len(features_scaled)):
-            X.append(features_scaled[i-self.sequence_length:i])
-            y.append(targets_scaled[i])
+        # Create sequences for LSTM, filling preallocated float32 arrays
+        n = max(0, len(features_scaled) - self.sequence_length)
+        X = np.empty((n, self.sequence_length, features_scaled.shape[1]), dtype=np.float32)
+        y = np.empty((n, targets_scaled.shape[1]), dtype=np.float32)
+        for i in range(n):
+            X[i] = features_scaled[i:i + self.sequence_length]
+            y[i] = targets_scaled[i + self.sequence_length]
         
-        return np.array(X), np.array(y)
+        return X, y
     
-    def _create_lstm_model(self, input_shape: Tuple[int, int], output_dim: int) -> Sequential:
+    def _create_lstm_model(self, input_shape: Tuple[int, int], output_dim: int) -> Any:
         """Create LSTM model architecture"""
+        from tensorflow.keras.models import Sequential
+        from tensorflow.keras.layers import LSTM, Dense, Dropout
+        from tensorflow.keras.optimizers import Adam
+        
         model = Sequential([
             LSTM(50, return_sequences=True, input_shape=input_shape),
             Dropout(0.2),
@@ -154,11 +209,13 @@ class PredictionService:
     def _train_model(self, df: pd.DataFrame):
         """Train the LSTM model"""
         try:
+            from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
+            
             # Prepare data
             X, y = self._prepare_data(df)
             
             if len(X) == 0:
-                print("Insufficient data for training")
+                logger.warning("Insufficient data for training")
                 return
             
             # Split data
@@ -196,146 +253,296 @@ class PredictionService:
             train_loss = self.model.evaluate(X_train, y_train, verbose=0)
             test_loss = self.model.evaluate(X_test, y_test, verbose=0)
             
-            print(f"Training loss: {train_loss[0]:.4f}, Test loss: {test_loss[0]:.4f}")
+            logger.info("Training loss: %.4f, Test loss: %.4f", train_loss[0], test_loss[0])
+            self._trace_model()
             
-            # Save scaler and categories
+            # Export the TFLite model, then save scalers and categories
+            self._compile_model(X_train, X_test, y_test)
             self._save_components()
             
-        except Exception as e:
-            print(f"Error training model: {e}")
+        except Exception:
+            logger.exception("Error training model")
+    
+    def _compile_model(self, X_calibration: np.ndarray = None,
+                       X_test: np.ndarray = None, y_test: np.ndarray = None):
+        """Convert the trained Keras model to TFLite and load it for inference"""
+        try:
+            tflite_model = None
+            if X_calibration is not None and len(X_calibration):
+                try:
+                    tflite_model = self._convert_model(X_calibration[:_QUANT_CALIBRATION_SAMPLES])
+                    if X_test is not None and len(X_test) and not self._quantization_ok(tflite_model, X_test, y_test):
+                        logger.info("int8 model exceeds the MSE tolerance, using dynamic-range quantization")
+                        tflite_model = None
+                except Exception:
+                    logger.exception("Error quantizing model to int8")
+                    tflite_model = None
+            if tflite_model is None:
+                tflite_model = self._convert_model()
+            
+            # The interpreter memory-maps the .tflite, so never truncate it in
+            # place: write a uniquely named temp file and swap it in
+            model_dir = os.path.dirname(self.tflite_path)
+            os.makedirs(model_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=model_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(tflite_model)
+                os.replace(tmp_path, self.tflite_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self._load_interpreter()
+        except Exception:
+            self.interpreter = None
+            logger.exception("Error compiling model")
+    
+    def _convert_model(self, X_calibration: np.ndarray = None) -> bytes:
+        """Convert the Keras model to a TFLite flatbuffer, int8 when calibration data is given"""
+        import tensorflow as tf
+        
+        converter = tf.lite.TFLiteConverter.from_keras_model(self.model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS,
+            tf.lite.OpsSet.SELECT_TF_OPS
+        ]
+        if X_calibration is not None:
+            converter.target_spec.supported_types = [tf.int8]
+            converter.representative_dataset = lambda: (
+                [x[np.newaxis].astype(np.float32)] for x in X_calibration
+            )
+        return converter.convert()
+    
+    def _quantization_ok(self, tflite_model: bytes, X_test: np.ndarray, y_test: np.ndarray) -> bool:
+        """Check the quantized model's held-out MSE against the Keras model's"""
+        import tensorflow as tf
+        
+        interpreter = tf.lite.Interpreter(model_content=tflite_model)
+        interpreter.allocate_tensors()
+        quantized_mse = np.mean((self._invoke(interpreter, X_test) - y_test) ** 2)
+        float_mse = np.mean((self._predict_fn(tf.constant(X_test, dtype=tf.float32)).numpy() - y_test) ** 2)
+        return quantized_mse - float_mse <= _QUANT_MSE_TOLERANCE
+    
+    def _load_compiled_model(self, bundle: Dict[str, Any]):
+        """Load the TFLite model, falling back to the Keras model if it is missing or stale"""
+        from tensorflow.keras.models import load_model
+        
+        # The bundle records the mtimes of the model files it was saved with;
+        # if they still match, the .tflite is current and Keras is never loaded
+        if (bundle.get("model_mtime") == os.path.getmtime(self.model_path) and
+            os.path.exists(self.tflite_path) and
+            bundle.get("tflite_mtime") == os.path.getmtime(self.tflite_path)):
+            try:
+                self._load_interpreter()
+                return
+            except Exception:
+                logger.exception("Error loading compiled model")
+        self.model = load_model(self.model_path)
+        self._trace_model()
+        self._compile_model()
+        self._save_components()
+    
+    def _trace_model(self):
+        """Wrap the Keras model in a tf.function with a fixed signature so it is traced once"""
+        import tensorflow as tf
+        
+        model = self.model
+        self._predict_fn = tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec([None, self.sequence_length, model.input_shape[-1]], tf.float32)]
+        )
+    
+    def _load_interpreter(self):
+        """Create a TFLite interpreter for the exported model"""
+        import tensorflow as tf
+        
+        interpreter = tf.lite.Interpreter(model_path=self.tflite_path)
+        interpreter.allocate_tensors()
+        self.interpreter = interpreter
+    
+    def _run_model(self, sequences: np.ndarray) -> np.ndarray:
+        """Run the LSTM on a batch of sequences, through TFLite when it is loaded"""
+        import tensorflow as tf
+        
+        if self.interpreter is None:
+            return self._predict_fn(tf.constant(sequences, dtype=tf.float32)).numpy()
+        
+        with self._interpreter_lock:
+            return self._invoke(self.interpreter, sequences)
+    
+    @staticmethod
+    def _invoke(interpreter: Any, sequences: np.ndarray) -> np.ndarray:
+        """Run a TFLite interpreter on a batch, resizing its input to the batch shape"""
+        sequences = sequences.astype(np.float32, copy=False)
+        input_detail = interpreter.get_input_details()[0]
+        if tuple(input_detail['shape']) != sequences.shape:
+            interpreter.resize_tensor_input(input_detail['index'], sequences.shape)
+            interpreter.allocate_tensors()
+        interpreter.set_tensor(input_detail['index'], sequences)
+        interpreter.invoke()
+        return interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
     
     def _save_components(self):
-        """Save scaler and categories"""
+        """Save scalers and categories"""
         try:
-            os.makedirs(os.path.dirname(self.scaler_path), exist_ok=True)
-            joblib.dump(self.scaler, self.scaler_path)
-            joblib.dump(self.categories, self.categories_path)
-            print("Model components saved successfully")
-        except Exception as e:
-            print(f"Error saving components: {e}")
+            os.makedirs(os.path.dirname(self.bundle_path), exist_ok=True)
+            bundle = {
+                "target_scaler": self.target_scaler,
+                "feature_scaler": self.feature_scaler,
+                "categories": self.categories,
+                "model_mtime": os.path.getmtime(self.model_path),
+                # Only point at the .tflite if it was exported from the current model
+                "tflite_mtime": os.path.getmtime(self.tflite_path) if self.interpreter is not None else None
+            }
+            # Uncompressed so the scaler arrays can be memory-mapped on load; written
+            # to a uniquely named temp file and swapped in since the old bundle may
+            # still be mapped and other workers may be saving at the same time
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.bundle_path), suffix='.tmp')
+            os.close(fd)
+            try:
+                joblib.dump(bundle, tmp_path, compress=0)
+                os.replace(tmp_path, self.bundle_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            logger.info("Model components saved successfully")
+        except Exception:
+            logger.exception("Error saving components")
     
     def predict_spending(self, user_id: int, spending_data: List[Dict], 
                         target_month: int, target_year: int) -> Dict[str, Any]:
         """Predict spending for a specific month"""
-        try:
-            if not spending_data:
-                return {
+        return self.predict_spending_batch([(user_id, spending_data, target_month, target_year)])[0]
+    
+    def predict_spending_batch(self, items: List[Tuple[int, List[Dict], int, int]]) -> List[Dict[str, Any]]:
+        """Predict spending for many users, running the LSTM once over all their sequences"""
+        model_ready = self.ensure_model()
+        results = [None] * len(items)
+        sequences, sequence_items = [], []
+        
+        for i, (user_id, spending_data, target_month, target_year) in enumerate(items):
+            try:
+                if not spending_data:
+                    results[i] = {
+                        "success": False,
+                        "error": "No spending data provided",
+                        "predictions": []
+                    }
+                    continue
+                
+                months, amounts = self._monthly_amounts(spending_data)
+                
+                if len(months) < self.sequence_length or not model_ready:
+                    # Not enough data for LSTM (or it is still training), use simple trend analysis
+                    results[i] = self._simple_prediction(amounts, target_month, target_year)
+                    continue
+                
+                # Prepare the last sequence_length months of (month, year) features
+                features = np.array([(month, year) for year, month in months[-self.sequence_length:]], dtype=np.float32)
+                sequences.append(self.feature_scaler.transform(features))
+                sequence_items.append(i)
+                
+            except Exception as e:
+                logger.exception("Error in prediction")
+                results[i] = {
                     "success": False,
-                    "error": "No spending data provided",
+                    "error": str(e),
                     "predictions": []
                 }
+        
+        if not sequences:
+            return results
+        
+        try:
+            # Make predictions for every user in one call
+            prediction_scaled = self._run_model(np.stack(sequences))
             
-            # Convert spending data to DataFrame
-            df = pd.DataFrame(spending_data)
-            df['date'] = pd.to_datetime(df['date'])
-            df['month'] = df['date'].dt.month
-            df['year'] = df['date'].dt.year
-            
-            # Convert amount to numeric (handle string values)
-            df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-            # Drop rows with invalid amounts
-            df = df.dropna(subset=['amount'])
-            
-            # Ensure category is a string and fill missing values
-            if 'category' in df.columns:
-                df['category'] = df['category'].fillna('other').astype(str)
-            else:
-                df['category'] = 'other'
-            
-            # Filter for expenses only (negative amounts)
-            df = df[df['amount'] < 0]
-            df['amount'] = df['amount'].abs()  # Make positive for prediction
-            
-            # Group by month/year and category
-            monthly_spending = df.groupby(['year', 'month', 'category'])['amount'].sum().reset_index()
-            
-            # Create pivot table
-            pivot_data = monthly_spending.pivot_table(
-                index=['year', 'month'], 
-                columns='category', 
-                values='amount', 
-                fill_value=0
-            ).reset_index()
-            
-            # Ensure all categories are present
-            for category in self.categories:
-                if category not in pivot_data.columns:
-                    pivot_data[category] = 0
-            
-            # Sort by year and month
-            pivot_data = pivot_data.sort_values(['year', 'month'])
-            
-            if len(pivot_data) < self.sequence_length:
-                # Not enough data for LSTM, use simple trend analysis
-                return self._simple_prediction(pivot_data, target_month, target_year)
-            
-            # Prepare data for prediction
-            features = pivot_data[['month', 'year']].values
-            features_scaled = self.scaler.transform(features)
+            # Inverse transform
+            prediction = self.target_scaler.inverse_transform(prediction_scaled)
             
-            # Create sequence for prediction
-            if len(features_scaled) >= self.sequence_length:
-                sequence = features_scaled[-self.sequence_length:]
-                sequence = sequence.reshape(1, self.sequence_length, -1)
-                
-                # Make prediction
-                prediction_scaled = self.model.predict(sequence, verbose=0)
-                
-                # Inverse transform
-                prediction = self.scaler.inverse_transform(prediction_scaled)[0]
+            for row, i in enumerate(sequence_items):
+                _, _, target_month, target_year = items[i]
                 
                 # Create predictions list
                 predictions = []
-                for i, category in enumerate(self.categories):
+                for j, category in enumerate(self.categories):
                     predictions.append({
                         'category': category,
-                        'predicted_amount': float(prediction[i]),
+                        'predicted_amount': float(prediction[row, j]),
                         'confidence': 0.8
                     })
                 
-                return {
+                results[i] = {
                     "success": True,
                     "predictions": predictions,
                     "method": "lstm_model",
                     "target_month": target_month,
                     "target_year": target_year
                 }
-            else:
-                return self._simple_prediction(pivot_data, target_month, target_year)
                 
         except Exception as e:
-            print(f"Error in prediction: {e}")
-            return {
-                "success": False,
-                "error": str(e),
-                "predictions": []
-            }
+            logger.exception("Error in prediction")
+            for i in sequence_items:
+                results[i] = {
+                    "success": False,
+                    "error": str(e),
+                    "predictions": []
+                }
+        
+        return results
+    
+    def _monthly_amounts(self, spending_data: List[Dict]) -> Tuple[List[Tuple[int, int]], np.ndarray]:
+        """Sum expenses into sorted (year, month) keys and a months x categories matrix"""
+        dates = pd.to_datetime([t['date'] for t in spending_data])
+        # Convert amount to numeric (handle string values); invalid amounts become NaN
+        amount = pd.to_numeric(pd.Series([t.get('amount') for t in spending_data], dtype=object),
+                               errors='coerce').to_numpy(dtype=float)
+        
+        # Expenses only (negative amounts), made positive for prediction; rows
+        # without a date are dropped like the groupby used to drop them
+        expense = (amount < 0) & ~dates.isna()
+        n_categories = len(self.categories)
+        if not expense.any():
+            return [], np.zeros((0, n_categories))
+        amount = -amount[expense]
+        years = dates.year.to_numpy()[expense].astype(np.int64)
+        month_numbers = dates.month.to_numpy()[expense].astype(np.int64)
+        
+        # Missing categories count as 'other'; categories outside self.categories
+        # land in a spare last column so they still count their month
+        category_index = _category_index(tuple(self.categories))
+        cat_idx = np.fromiter(
+            (category_index.get('other' if pd.isna(c) else str(c), n_categories)
+             for c, keep in zip((t.get('category') for t in spending_data), expense) if keep),
+            dtype=np.intp, count=len(amount))
+        
+        # Histogram of spending per (month bucket, category), in chronological order
+        min_year = years.min()
+        bucket = (years - min_year) * 12 + (month_numbers - 1)
+        n_buckets = bucket.max() + 1
+        grid = np.zeros((n_buckets, n_categories + 1))
+        np.add.at(grid, (bucket, cat_idx), amount)
+        
+        # Keep only months that have at least one expense
+        present = np.bincount(bucket, minlength=n_buckets) > 0
+        months = [(int(min_year + b // 12), int(b % 12 + 1)) for b in np.flatnonzero(present)]
+        return months, grid[present, :n_categories]
     
-    def _simple_prediction(self, pivot_data: pd.DataFrame, 
+    def _simple_prediction(self, amounts: np.ndarray, 
                           target_month: int, target_year: int) -> Dict[str, Any]:
         """Simple prediction using trend analysis when insufficient data"""
-        predictions = []
+        # Average spending per category over the observed months
+        avg_spending = amounts.mean(axis=0) if len(amounts) else np.zeros(len(self.categories))
         
-        for category in self.categories:
-            if category in pivot_data.columns:
-                # Calculate average spending for this category
-                avg_spending = pivot_data[category].mean()
-                
-                # Add some seasonal adjustment
-                seasonal_multiplier = self._get_seasonal_multiplier(target_month, category)
-                predicted_amount = avg_spending * seasonal_multiplier
-                
-                predictions.append({
-                    'category': category,
-                    'predicted_amount': float(predicted_amount),
-                    'confidence': 0.6
-                })
-            else:
-                predictions.append({
-                    'category': category,
-                    'predicted_amount': 0.0,
-                    'confidence': 0.3
-                })
+        # Add some seasonal adjustment
+        if 1 <= target_month <= 12:
+            avg_spending = avg_spending * _seasonal_table(tuple(self.categories))[:, target_month - 1]
+        
+        predictions = [
+            {'category': category, 'predicted_amount': float(amount), 'confidence': 0.6}
+            for category, amount in zip(self.categories, avg_spending)
+        ]
         
         return {
             "success": True,
@@ -345,21 +552,14 @@ class PredictionService:
             "target_year": target_year
         }
     
-    def _get_seasonal_multiplier(self, month: int, category: str) -> float:
-        """Get seasonal multiplier for different categories"""
-        seasonal_factors = {
-            'food': {11: 1.1, 12: 1.2, 1: 1.1, 6: 1.0, 7: 1.0, 8: 1.0},
-            'shopping': {11: 1.5, 12: 1.8, 1: 1.3, 6: 0.9, 7: 0.8, 8: 0.9},
-            'entertainment': {11: 1.2, 12: 1.3, 1: 1.1, 6: 1.2, 7: 1.3, 8: 1.2},
-            'travel': {6: 1.4, 7: 1.5, 8: 1.4, 11: 1.1, 12: 1.2, 1: 0.8},
-            'utilities': {12: 1.2, 1: 1.3, 2: 1.2, 6: 1.1, 7: 1.2, 8: 1.1}
-        }
-        
-        return seasonal_factors.get(category, {}).get(month, 1.0)
-    
     def retrain_model(self, user_id: int, new_data: List[Dict]) -> Dict[str, Any]:
         """Retrain model with new data"""
         try:
+            # Let a pending initial training finish before retraining on top of it
+            self.ensure_model()
+            if self._init_thread is not None:
+                self._init_thread.join()
+            
             # Convert new data to DataFrame
             df = pd.DataFrame(new_data)
             df['date'] = pd.to_datetime(df['date'])